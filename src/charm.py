@@ -71,6 +71,8 @@ class BlockchainMonitorCharm(ops.CharmBase):
         try:
             util.update_monitor_config_file(self.config)
             util.restart_service(c.SERVICE_NAME_BC)
+            # The exporter removes the key from the URLs of older data, which was stored with it
+            util.update_exporter_config(["api-key"], self.config.get("api-key"))
         except FileNotFoundError as e:
             self.unit.status = BlockedStatus(str(e))
             event.defer()
@@ -109,6 +111,9 @@ class BlockchainMonitorCharm(ops.CharmBase):
 
     def _on_upgrade_charm(self, event: ops.UpgradeCharmEvent):
         """Handle charm upgrade."""
+        # The monitor's requirements may have changed, install them before it's restarted
+        self.unit.status = MaintenanceStatus("Installing Python dependencies")
+        util.install_python_dependencies(self.charm_dir / "templates/requirements_monitor.txt")
         # TODO: also restart exporter service
         util.install_bcm(restart_service=True)
         util.install_ch_exporter()
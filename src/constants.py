@@ -9,12 +9,14 @@ SERVICE_NAME_BC = "bc-monitor"
 SERVICE_NAME_INFLUX = "influxdb"
 MONITOR_SCRIPT_NAME = "monitor-blockchains.py"
 MONITOR_CONFIG_NAME = "config.json"
+MONITOR_API_CLASSES_NAME = "api-classes.yaml"
 
 # Paths
 HOME_DIR = Path("/home/ubuntu")
 INFLUXDB_TOKEN_PATH = HOME_DIR / "influxdb_token"
 MONITOR_SCRIPT_PATH = HOME_DIR / MONITOR_SCRIPT_NAME
 MONITOR_CONFIG_PATH = HOME_DIR / MONITOR_CONFIG_NAME
+MONITOR_API_CLASSES_PATH = HOME_DIR / MONITOR_API_CLASSES_NAME
 
 # Exporter
 EXPORTER_DIR = HOME_DIR / "clickhouse-exporter"
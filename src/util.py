@@ -37,11 +37,15 @@ def install_bcm(restart_service: bool = False) -> None:
         "templates/monitor-blockchains.py",
         c.MONITOR_SCRIPT_PATH,
     )
+    copied_api_classes = copy_if_different(
+        f"templates/{c.MONITOR_API_CLASSES_NAME}",
+        c.MONITOR_API_CLASSES_PATH,
+    )
     copied_service = copy_if_different(
         f"templates/etc/systemd/system/{c.SERVICE_NAME_BC}.service",
         Path(f"/etc/systemd/system/{c.SERVICE_NAME_BC.lower()}.service"),
     )
-    if any([copied_script, copied_service]) and restart_service:
+    if any([copied_script, copied_api_classes, copied_service]) and restart_service:
         restart_service(c.SERVICE_NAME_BC)
         sp.run(["systemctl", "daemon-reload"], check=False)
     else:
@@ -122,10 +126,36 @@ def update_monitor_config_file(config: ConfigData) -> None:
     monitoring_config["INFLUXDB_ORG"] = config.get("influxdb-org")
     monitoring_config["INFLUXDB_URL"] = config.get("influxdb-url")
     monitoring_config["INFLUXDB_TOKEN"] = get_influxdb_token()
+    monitoring_config["INFLUXDB_BATCH_SIZE"] = config.get("influxdb-batch-size")
+    monitoring_config["INFLUXDB_FLUSH_INTERVAL"] = config.get("influxdb-flush-interval")
+    monitoring_config["INFLUXDB_QUEUE_SIZE"] = config.get("influxdb-queue-size")
+    monitoring_config["INFLUXDB_WRITE_PRECISION"] = config.get("influxdb-write-precision")
+    monitoring_config["SPOOL_DIR"] = config.get("spool-dir")
+    monitoring_config["SPOOL_MAX_SIZE"] = config.get("spool-max-size")
+    monitoring_config["SPOOL_SEGMENT_SIZE"] = config.get("spool-segment-size")
+    monitoring_config["SPOOL_FSYNC"] = config.get("spool-fsync")
     monitoring_config["REQUEST_INTERVAL"] = config.get("request-interval")
+    monitoring_config["BLOCK_LAG_THRESHOLD"] = config.get("block-lag-threshold")
     monitoring_config["REQUEST_CONCURRENCY"] = config.get("request-concurrency")
+    monitoring_config["REQUEST_CONCURRENCY_MIN"] = config.get("request-concurrency-min")
+    monitoring_config["REQUEST_CONCURRENCY_MAX"] = config.get("request-concurrency-max")
+    monitoring_config["SHARD_COUNT"] = config.get("shard-count")
+    monitoring_config["REQUEST_RATE_LIMIT"] = config.get("request-rate-limit")
+    monitoring_config["HOST_RATE_LIMIT"] = config.get("host-rate-limit")
+    monitoring_config["CIRCUIT_BREAKER_THRESHOLD"] = config.get("circuit-breaker-threshold")
+    monitoring_config["MAX_HOST_CONNECTIONS"] = config.get("max-host-connections")
+    monitoring_config["HTTP2"] = config.get("http2")
+    monitoring_config["DNS_CACHE_TTL"] = config.get("dns-cache-ttl")
+    monitoring_config["REQUEST_TELEMETRY_FIELDS"] = [
+        field.strip() for field in (config.get("request-telemetry-fields") or "").split(",") if field.strip()
+    ]
+    monitoring_config["PROBE_BACKEND"] = config.get("probe-backend")
+    monitoring_config["HEAD_SUBSCRIPTIONS"] = config.get("head-subscriptions")
     monitoring_config["RPC_ENDPOINT_DB_URL"] = config.get("rpc-endpoint-api-url")
     monitoring_config["RPC_CACHE_MAX_AGE"] = config.get("rpc-endpoint-cache-age")
+    monitoring_config["CATALOG_BULK_ROUTE"] = config.get("catalog-bulk-route")
+    monitoring_config["API_KEY"] = config.get("api-key")
+    monitoring_config["URL_REWRITE_RULES"] = yaml.safe_load(config.get("url-rewrite-rules") or "[]")
     monitoring_config["LOG_LEVEL"] = config.get("log-level")
     with open(c.MONITOR_CONFIG_PATH, "w", encoding="utf-8") as f:
         json.dump(monitoring_config, f)
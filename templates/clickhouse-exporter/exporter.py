@@ -20,6 +20,8 @@ logger = logging.getLogger()
 HOME_DIR = Path("/home/ubuntu")
 EXPORTER_DIR = HOME_DIR / "clickhouse-exporter"
 CONFIG_FILE = EXPORTER_DIR / "exporter-config.yaml"
+# The API key the monitor had built in before the key was configurable, older data has it in the URLs
+LEGACY_API_KEY = "12345678-f359-43a8-89aa-3219a362396f"
 
 
 def get_influx_client(config: dict) -> InfluxDBClient:
@@ -105,7 +107,7 @@ def influx_result_to_list_of_dicts(result: TableList) -> (list[dict], list[dict]
     return list(block_height_data.values()), list(max_height_data.values())
 
 
-def prepare_data_for_clickhouse(table: str, dict_rows: list[dict]) -> list[tuple]:
+def prepare_data_for_clickhouse(table: str, dict_rows: list[dict], api_key: str = "") -> list[tuple]:
     """Prepare data for insertion into ClickHouse.
 
     Converts the list of dictionaries into a list of tuples that match the
@@ -114,23 +116,27 @@ def prepare_data_for_clickhouse(table: str, dict_rows: list[dict]) -> list[tuple
     - max_height_over_time
     """
     if table == "block_height_requests":
-        return prepare_block_height_request_data(dict_rows)
+        return prepare_block_height_request_data(dict_rows, api_key)
     elif table == "max_height_over_time":
         return prepare_max_height_over_time_data(dict_rows)
     else:
         raise ValueError(f"Unknown table: {table}")
 
 
-def prepare_block_height_request_data(dict_rows: list[dict]) -> list[tuple]:
+def prepare_block_height_request_data(dict_rows: list[dict], api_key: str = "") -> list[tuple]:
     """Convert listed dicts to a list matching the block_height_requests table.
 
     Converts each dictionary in `dict_rows` into a tuple that matches
     the column order in the ClickHouse table, and returns a list of these tuples.
+    The `api_key` and the LEGACY_API_KEY are removed from the URLs.
     """
+    api_keys = [key for key in [api_key, LEGACY_API_KEY] if key]
     prepared_rows = []
     for d in dict_rows:
-        # Handle special case, as some older data contains this API key in the URL
-        url = d["url"].replace("/12345678-f359-43a8-89aa-3219a362396f", "")
+        # Handle special case, as older data contains the API key in the URL
+        url = d["url"]
+        for key in api_keys:
+            url = url.replace(f"/{key}", "")
         http_code = np.int32(d.get("http_code", 0))
         request_time = np.float32(d.get("request_time_total", 0.0))
 
@@ -277,7 +283,7 @@ class BCMDataExporter:
             self.connect_clickhouse()
 
         # Prepare data
-        prepared_data = prepare_data_for_clickhouse(table, data)
+        prepared_data = prepare_data_for_clickhouse(table, data, self.config.get("api-key", ""))
 
         if (self.verbose or self.dry_run_ch) and prepared_data:
             logger.info("Prepared data for ClickHouse:\n%s\n...\n%s", prepared_data[0], prepared_data[-1])
@@ -2,43 +2,113 @@
 
 """Monitor the blockchains."""
 
+import asyncio
+import atexit
+import heapq
+import ipaddress
+import itertools
 import json
 import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
 import re
+import signal
 import socket
 import sys
+import threading
 import time
-from datetime import datetime
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
 
 # TODO: move to readme during readme update
 # pycurl docs: http://pycurl.io/docs/latest/index.html
-from io import BytesIO
 from pathlib import Path
 from statistics import mean
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 
+import aiohttp
+import numpy as np
 import pycurl
 import requests
 import websocket
-from influxdb_client import InfluxDBClient, Point
+import yaml
+from influxdb_client import InfluxDBClient
 from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+
+try:
+    from orjson import loads as loads_json
+except ImportError:
+    # The standard library parses bytes too, only slower
+    from json import loads as loads_json
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger()
 
 REQUEST_TIMEOUT = 4000
 WS_TIMEOUT = 3.5
-
-
-HTTP_GET_APIS = [
-    "sidecar",
-    "waves",
-    "cosmos-tendermint",
-    "eos",
-    "eth-v1-beacon",
-    "tron",
-    "movement",
-    "tonv3",
+WS_RECONNECT_BACKOFF = 1.0
+WS_RECONNECT_MAX_BACKOFF = 120.0
+HEAD_SUBSCRIPTION_TIMEOUT = 60.0
+SHARD_REPORT_INTERVAL = 0.5
+INFLUXDB_RETRY_BACKOFF = 1.0
+INFLUXDB_RETRY_MAX_BACKOFF = 60.0
+BEACON_EVENTS_PATH = "/eth/v1/events?topics=head"
+API_CLASSES_FILE = "api-classes.yaml"
+CATALOG_REFRESH_CONCURRENCY = 16
+CATALOG_BULK_PATH = "/all/endpoints"
+CONCURRENCY_DECREASE_FACTOR = 0.75
+CONCURRENCY_LATENCY_TOLERANCE = 1.5
+CONCURRENCY_ERROR_TOLERANCE = 0.05
+CONCURRENCY_BASELINE_WEIGHT = 0.1
+CONCURRENCY_MAX_QUEUE_WAIT = 0.1
+DNS_FAILURE_TTL = 30.0
+THROTTLE_MAX_BACKOFF = 900.0
+CIRCUIT_BREAKER_MAX_BACKOFF = 900.0
+# JSON-RPC error codes of hit rate limits and quotas, e.g. -32004 for a daily relay limit, -32005 for a request limit
+JSON_RPC_QUOTA_ERRORS = {-32004, -32005}
+# The curl errors of endpoints that couldn't be reached, by error number: the HTTP code reported and what happened
+UNREACHABLE_CURL_ERRORS = {
+    pycurl.E_COULDNT_RESOLVE_HOST: (404, "Could not resolve host"),  # HTTP status code for Not Found
+    pycurl.E_COULDNT_CONNECT: (404, "No route to host"),
+    pycurl.E_OPERATION_TIMEDOUT: (408, "Connection timed out"),  # HTTP status code for Request Timeout
+}
+
+# The libcurl transfer telemetry that can be written as extra fields of the requests, by field name: the info to get
+# from the handle, and the array typecode of its result table column
+REQUEST_TELEMETRY_FIELDS = {
+    "request_time_namelookup": (pycurl.NAMELOOKUP_TIME, "d"),
+    "request_time_connect": (pycurl.CONNECT_TIME, "d"),
+    "request_time_appconnect": (pycurl.APPCONNECT_TIME, "d"),
+    "request_time_pretransfer": (pycurl.PRETRANSFER_TIME, "d"),
+    "request_time_starttransfer": (pycurl.STARTTRANSFER_TIME, "d"),
+    "request_size_download": (pycurl.SIZE_DOWNLOAD_T, "q"),
+    "request_size_upload": (pycurl.SIZE_UPLOAD_T, "q"),
+    "request_size_header": (pycurl.HEADER_SIZE, "q"),
+}
+
+# Timestamp multipliers per line protocol write precision
+LINE_PROTOCOL_PRECISIONS = {"s": 1, "ms": 1000}
+LINE_PROTOCOL_TAG_ESCAPES = str.maketrans(
+    {"\\": "\\\\", ",": "\\,", " ": "\\ ", "=": "\\=", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+)
+
+
+# TODO: if error 1010 pops up again, try rotating user agents per https://www.scrapehero.com/how-to-fake-and-rotate-user-agents-using-python-3/
+GET_HEADERS = [
+    "Connection: keep-alive",
+    "User-Agent: Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/118.0",
+]
+POST_HEADERS = [
+    "Connection: keep-alive",
+    "Content-Type: application/json",
+    "User-Agent: Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/118.0",
 ]
 
 
@@ -65,17 +135,46 @@ def main():
         logger.warning("Log level error [%s], level set to 'INFO'.", e)
     logger.setLevel(log_level)
 
+    # Load the API class registry
+    API_CLASSES.update(load_api_classes(Path.cwd() / API_CLASSES_FILE))
+    logger.info("Loaded %s API classes", len(API_CLASSES))
+
     # Set up variables from config
     influxdb = {
         "url": config["INFLUXDB_URL"],
         "token": config["INFLUXDB_TOKEN"],
         "org": config["INFLUXDB_ORG"],
         "bucket": config["INFLUXDB_BUCKET"],
+        "batch_size": config.get("INFLUXDB_BATCH_SIZE", 5000),
+        "flush_interval": config.get("INFLUXDB_FLUSH_INTERVAL", 1.0),
+        "queue_size": config.get("INFLUXDB_QUEUE_SIZE", 100000),
+        "precision": config.get("INFLUXDB_WRITE_PRECISION", "s"),
     }
+    spool_dir = config.get("SPOOL_DIR", "spool")
     cache_max_age = config["RPC_CACHE_MAX_AGE"]
     request_interval = config["REQUEST_INTERVAL"]
     request_concurrency = config["REQUEST_CONCURRENCY"]
+    concurrency_floor = config.get("REQUEST_CONCURRENCY_MIN", 0)
+    concurrency_ceiling = config.get("REQUEST_CONCURRENCY_MAX", 0)
+    dns_cache_ttl = config.get("DNS_CACHE_TTL", 300)
+    telemetry_fields = config.get("REQUEST_TELEMETRY_FIELDS", [])
+    for field in telemetry_fields:
+        if field not in REQUEST_TELEMETRY_FIELDS:
+            raise ValueError("Invalid request telemetry field:", field)
+    engine_options = {
+        "max_host_connections": config.get("MAX_HOST_CONNECTIONS", 6),
+        "http2": config.get("HTTP2", True),
+        "telemetry_fields": telemetry_fields,
+    }
+    shard_count = config.get("SHARD_COUNT", 1)
     rpc_endpoint_db_url = config["RPC_ENDPOINT_DB_URL"]
+    request_rate_limit = config.get("REQUEST_RATE_LIMIT", 0)
+    host_rate_limit = config.get("HOST_RATE_LIMIT", 0)
+    breaker_threshold = config.get("CIRCUIT_BREAKER_THRESHOLD", 3)
+    probe_backend = config.get("PROBE_BACKEND", "pycurl")
+    head_subscriptions = config.get("HEAD_SUBSCRIPTIONS", False)
+    block_lag_threshold = config.get("BLOCK_LAG_THRESHOLD", 5)
+    url_rewriter = UrlRewriter(config.get("URL_REWRITE_RULES", []), config.get("API_KEY", ""))
 
     # Test connection to influx before attempting to start
     if not test_influxdb_connection(influxdb["url"], influxdb["token"], influxdb["org"]):
@@ -85,134 +184,190 @@ def main():
         logger.error("Couldn't connect to the RPC Flask API at url %s\nExiting.", rpc_endpoint_db_url)
         sys.exit(1)
     logger.info("Connection tested.")
-
-    program_counter = {"loop_time": [], "failed_requests": []}
+    # systemd stops the monitor with SIGTERM, exit normally on it so that everything started below is shut down, and
+    # the writer flushed, by the exit handlers on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if shard_count > 1:
+        probe_runner = ShardedProbeRunner(
+            shard_count,
+            probe_backend,
+            request_concurrency,
+            request_interval,
+            request_rate_limit,
+            concurrency_floor,
+            concurrency_ceiling,
+            engine_options,
+            host_rate_limit,
+            breaker_threshold,
+        )
+    else:
+        probe_engine = get_probe_engine(probe_backend, num_connections=request_concurrency, **engine_options)
+        controller = get_concurrency_controller(
+            request_concurrency, concurrency_floor, concurrency_ceiling, request_interval
+        )
+        probe_runner = ProbeRunner(
+            probe_engine, request_interval, request_rate_limit, controller, host_rate_limit, breaker_threshold
+        )
+    atexit.register(probe_runner.close)
+    spool = None
+    if spool_dir:
+        spool = ResultSpool(
+            spool_dir,
+            max_size=config.get("SPOOL_MAX_SIZE", 512) * 1024 * 1024,
+            segment_size=config.get("SPOOL_SEGMENT_SIZE", 8) * 1024 * 1024,
+            fsync=config.get("SPOOL_FSYNC", "segment"),
+            precision=influxdb["precision"],
+        )
+    influxdb_writer = InfluxWriter(**influxdb, spool=spool)
+    atexit.register(influxdb_writer.close)
+    serializer = LineProtocolSerializer(influxdb["precision"], telemetry_fields)
+    head_tracker = HeadTracker() if head_subscriptions else None
+    if head_tracker:
+        atexit.register(head_tracker.close)
+    # Only curl can be handed the resolved addresses
+    resolver = HostResolver(dns_cache_ttl) if dns_cache_ttl and probe_backend == "pycurl" else None
+    if resolver:
+        atexit.register(resolver.close)
+    catalog_client = CatalogClient(rpc_endpoint_db_url, bulk=config.get("CATALOG_BULK_ROUTE", False))
+    atexit.register(catalog_client.close)
+    endpoint_cache = EndpointCache(catalog_client, url_rewriter, "cache.json", cache_max_age)
+    atexit.register(endpoint_cache.close)
+    result_table = ResultTable(telemetry_fields)
+    program_counter = {"processing_time": [], "failed_requests": []}
+    # The write windows are aligned with the request deadlines of the chains, see ProbeScheduler
+    time_window_end = get_window_end(time.monotonic(), request_interval) - request_interval
+    loaded_endpoints = None
+    tracked_version = None
+    resolves = {}
+    subscribed_endpoints = []
     while True:
         logger.info("- MONITOR LOOP START")
         time_loop_start = time.time()
-        all_endpoints = load_endpoints(rpc_endpoint_db_url, cache_max_age)
+        all_endpoints = endpoint_cache.get()
         time_endpoints_loaded = time.time()
+        # The cache hands out a new list only when the catalog has changed
+        catalog_changed = all_endpoints is not loaded_endpoints
+        if catalog_changed:
+            loaded_endpoints = all_endpoints
+            result_table.set_endpoints(all_endpoints)
+            if head_tracker:
+                head_tracker.sync(all_endpoints)
+            if resolver:
+                resolver.set_hosts(get_http_hosts(all_endpoints))
+        if resolver:
+            resolver.refresh()
+        # Partition the endpoints again only when the catalog, the set of tracked endpoints or the resolved
+        # addresses have changed
+        head_tracker_version = head_tracker.version if head_tracker else None
+        resolves_changed = resolver is not None and resolver.resolves is not resolves
+        if catalog_changed or head_tracker_version != tracked_version or resolves_changed:
+            tracked_version = head_tracker_version
+            resolves = resolver.resolves if resolver else {}
+            http_endpoints, ws_endpoints = split_endpoints_by_scheme(all_endpoints)
+            if head_tracker:
+                subscribed_http_endpoints, http_endpoints = head_tracker.partition(http_endpoints)
+                subscribed_ws_endpoints, ws_endpoints = head_tracker.partition(ws_endpoints)
+                subscribed_endpoints = subscribed_http_endpoints + subscribed_ws_endpoints
+            probe_runner.update_endpoints(http_endpoints, ws_endpoints, resolves)
         logger.info("Endpoints loaded")
-        # TODO: split here based on wss vs http, implement aiohttp approach for wss?
-        all_results = fetch_results_pycurl(endpoints=all_endpoints, num_connections=request_concurrency)
+        # Collect the results of the requests made until the end of this loop's interval
+        time_window_end = time_window_end + request_interval
+        if time_window_end < time.monotonic():
+            logger.warning("Loop processing overran the request interval, results are written late")
+            time_window_end = get_window_end(time.monotonic(), request_interval)
+        result_table.clear()
+        probe_runner.collect(until=time_window_end, add_result=result_table.add)
+        if head_tracker:
+            head_tracker.add_results(result_table, subscribed_endpoints)
         time_results_fetched = time.time()
 
-        # Create block_heights dict
+        # Calculate block_height maxes and lags per chain id
         logger.info("Sorting results")
-        block_heights = {}
-        for result in all_results:
-            try:
-                if result and result.get("latest_block_height"):
-                    try:
-                        chain = result.get("chain")
-                        url = result.get("url")
-                    except KeyError as e:
-                        logger.error("KeyError when accessing result [%s], error: [%s]", result, e)
-                        continue
-                    if chain not in block_heights.keys():
-                        block_heights[chain] = []
-                    block_heights[chain].append((url, result.get("latest_block_height")))
-            except (AttributeError, UnboundLocalError) as e:
-                logger.error(f"{e.__class__.__name__} for {result}, %s", e)
-        # Calculate block_height diffs and maxes
-        block_height_diffs = {}
-        chain_max_heights = {}
-        for chain in block_heights:
-            rpc_list = block_heights[chain]
-            block_height_diffs[chain] = {}
-            max_height = max(rpc_list, key=lambda x: x[1])[1]
-            chain_max_heights[chain] = max_height
-            for rpc in rpc_list:
-                block_height_diffs[chain][rpc[0]] = max_height - rpc[1]
+        aggregation = aggregate_block_heights(result_table, block_lag_threshold)
+        rows = aggregation["rows"]
+        lags = aggregation["lags"]
         time_block_calc_done = time.time()
 
         logger.info("- PARSE RESULTS")
-        timestamp = datetime.utcnow()
-        records = []
-        loop_counter = {"failed_requests": 0, "http": 0, "ws": 0}
+        serializer.start(time.time())
+        loop_counter = {"failed_requests": 0, "throttled_requests": 0, "open_circuits": 0, "http": 0, "ws": 0}
         # TODO: do result loop by chain, and set timestamp per chain
-        # Create and append RPC data points
-        for result in all_results:
-            if result:
-                try:
-                    try:
-                        http_code = result.get("http_code") or -2
-                        chain = result.get("chain")
-                        url = result.get("url")
-                    except KeyError as e:
-                        logger.error("KeyError when accessing result [%s], error: [%s]", result, e)
-                        continue
-                    if "http" in url:
-                        loop_counter["http"] = loop_counter["http"] + 1
-                    elif "ws" in url:
-                        loop_counter["ws"] = loop_counter["ws"] + 1
-                    # TODO: clean up the point creation
-                    # TODO: handle code 429 specially, usually means rate limit hit
-                    block_height_diff = get_block_height_diff(block_height_diffs, chain, url)
-                    if http_code != 200:
-                        logger.warning("HTTP code [%s] for %s, something went wrong with the request.", http_code, url)
-                        brp = block_height_request_point(
-                            chain=chain,
-                            url=url,
-                            data=result,
-                            block_height_diff=block_height_diff,
-                            timestamp=timestamp,
-                            http_code=http_code,
-                        )
-                        loop_counter["failed_requests"] = loop_counter["failed_requests"] + 1
-                    else:
-                        brp = block_height_request_point(
-                            chain=chain,
-                            url=url,
-                            data=result,
-                            block_height_diff=block_height_diff,
-                            timestamp=timestamp,
-                            http_code=http_code,
-                        )
-                    # logger.debug("Writing point to InfluxDB: %s", brp)
-                    records.append(brp)
-                except KeyError as e:
-                    logger.error(
-                        "KeyError while accessing results for [%s], results: [%s], key: [%s]", url, result, str(e)
-                    )
-                except Exception as e:
-                    logger.error(
-                        "%s while accessing results for [%s], results: [%s], error: [%s]",
-                        {e.__class__.__name__},
-                        url,
-                        result,
-                        str(e),
-                    )
-            else:
-                logger.warning("Couldn't get results from [%s]. Skipping.", url)
-        time_results_parsed = time.time()
-
-        # Create and append max block height data points
-        for chain, max_height in chain_max_heights.items():
-            records.append(
-                Point("block_height_request")
-                .tag("chain", chain)
-                .tag("url", "zzz - Max over time")  # 'zzz' to sort it last, is removed in Grafana
-                .field("block_height", max_height)
-                .time(timestamp)
+        # Write RPC data lines
+        http_codes = result_table.http_code
+        block_heights = result_table.block_height
+        time_totals = result_table.time_total
+        subscriptions = result_table.subscription
+        throttled = result_table.throttled
+        circuit_open = result_table.circuit_open
+        telemetry_columns = list(result_table.telemetry.values())
+        has_telemetry = result_table.has_telemetry
+        for row in rows:
+            chain, url, *_ = result_table.endpoints[row]
+            http_code = http_codes[row]
+            block_height = block_heights[row]
+            if "http" in url:
+                loop_counter["http"] = loop_counter["http"] + 1
+            elif "ws" in url:
+                loop_counter["ws"] = loop_counter["ws"] + 1
+            block_height_diff = lags[row] if lags[row] >= 0 else None
+            # Rate limited endpoints aren't failing, they're held back until the rate limit lifts
+            if throttled[row]:
+                loop_counter["throttled_requests"] = loop_counter["throttled_requests"] + 1
+            elif circuit_open[row]:
+                loop_counter["open_circuits"] = loop_counter["open_circuits"] + 1
+                loop_counter["failed_requests"] = loop_counter["failed_requests"] + 1
+            elif http_code != 200:
+                logger.warning("HTTP code [%s] for %s, something went wrong with the request.", http_code, url)
+                loop_counter["failed_requests"] = loop_counter["failed_requests"] + 1
+            telemetry = [column[row] for column in telemetry_columns] if has_telemetry[row] else None
+            serializer.add_request(
+                chain,
+                url,
+                http_code,
+                block_height,
+                block_height_diff,
+                time_totals[row],
+                subscriptions[row],
+                telemetry,
+                throttled[row],
+                circuit_open[row],
             )
-        logger.info("Writing %s records to InfluxDB", len(records))
-        write_to_influxdb(influxdb["url"], influxdb["token"], influxdb["org"], influxdb["bucket"], records)
+
+        # Write max block height data lines
+        for chain_id, max_height in zip(aggregation["chain_ids"], aggregation["max_heights"]):
+            serializer.add_max(result_table.chains[chain_id], max_height)
+        # Write the per-chain summary lines
+        for chain_id, count, median_lag, within_threshold in zip(
+            aggregation["chain_ids"], aggregation["counts"], aggregation["median_lags"], aggregation["within_threshold"]
+        ):
+            serializer.add_chain_summary(result_table.chains[chain_id], count, median_lag, within_threshold)
+        if concurrency_ceiling:
+            serializer.add_concurrency(probe_runner.concurrency)
+        # Write the DNS health lines of the hosts
+        if resolver:
+            for host, addresses in resolver.results.items():
+                serializer.add_host_resolution(host, len(addresses))
+        time_results_parsed = time.time()
+        logger.info("Writing %s records to InfluxDB", serializer.count)
+        influxdb_writer.write(serializer.getvalue(), serializer.count)
         time_influxdb_written = time.time()
 
         logger.info("- MONITOR LOOP END")
         loop_time = time.time() - time_loop_start
-        logger.info("Loop - Processed requests:   %s/%s", len(all_results), len(all_endpoints))
+        processing_time = time.time() - time_results_fetched
+        logger.info("Loop - Processed requests:   %s/%s", len(rows), len(all_endpoints))
         logger.info("Loop - Failed requests:      %s", loop_counter["failed_requests"])
+        logger.info("Loop - Throttled requests:   %s", loop_counter["throttled_requests"])
+        logger.info("Loop - Open circuits:        %s", loop_counter["open_circuits"])
         logger.info("Loop - Endpoints using http: %s", loop_counter["http"])
         logger.info("Loop - Endpoints using ws:   %s", loop_counter["ws"])
-        mean_time = loop_time / len(all_endpoints)
-        logger.info("Loop - Processing time:      %.3fs (mean %.3fs)", loop_time, mean_time)
-        program_counter["loop_time"].append(loop_time)
+        logger.info("Loop - Loop time:            %.3fs", loop_time)
+        logger.info("Loop - Processing time:      %.3fs", processing_time)
+        program_counter["processing_time"].append(processing_time)
         program_counter["failed_requests"].append(loop_counter["failed_requests"])
         # TODO: make these counters only average last 1/6/24h? Average over longer times might mean little
-        logger.info("Program - Loops since program start: %s", len(program_counter["loop_time"]))
-        logger.info("Program - Mean loop processing time: %.3fs", mean(program_counter["loop_time"]))
+        logger.info("Program - Loops since program start: %s", len(program_counter["processing_time"]))
+        logger.info("Program - Mean loop processing time: %.3fs", mean(program_counter["processing_time"]))
         logger.info("Program - Average failed requests:   %.2f", mean(program_counter["failed_requests"]))
 
         # Debugging info
@@ -222,17 +377,19 @@ def main():
         parse_results_time = time_results_parsed - time_block_calc_done
         write_influx_time = time_influxdb_written - time_results_parsed
 
-        logger.debug("Config - Concurrent connections: %s", request_concurrency)
+        logger.debug("Config - Probe backend: %s", probe_backend)
+        logger.debug("Config - Concurrent connections: %s", probe_runner.concurrency)
+        logger.debug("Config - Probe shards: %s", shard_count)
+        logger.debug("Config - Max connections per host: %s", engine_options["max_host_connections"] or "-")
+        logger.debug("Config - HTTP/2: %s", engine_options["http2"])
+        logger.debug("Config - Request rate limit: %s/s", request_rate_limit or "-")
+        logger.debug("Config - Subscribed endpoints: %s", len(subscribed_endpoints))
         logger.debug("Time data - Loading endpoints: %.3fs", endpoints_load_time)
         logger.debug("Time data - Fetching results: %.3fs", fetch_results_time)
         logger.debug("Time data - Block calculations: %.3fs", block_calc_time)
         logger.debug("Time data - Parse results: %.3fs", parse_results_time)
         logger.debug("Time data - Write to InfluxDB: %.3fs", write_influx_time)
 
-        logger.info("Sleeping for %s seconds...", request_interval)
-        # Sleep between making requests to avoid triggering rate limits.
-        time.sleep(request_interval)
-
 
 def test_influxdb_connection(url: str, token: str, org: str) -> bool:
     """Test the connection to the database."""
@@ -255,79 +412,494 @@ def test_connection(url: str) -> bool:
         logger.warning("Connection to URL failed: %s", str(e))
 
 
-def load_endpoints(rpc_endpoint_db_url: str, cache_refresh_interval: int) -> list:
-    """Get the RPC endpoints for all chains in the RPC database."""
-    return load_from_flask_api(rpc_endpoint_db_url, "cache.json", cache_refresh_interval)
+class EndpointCache:
+    """The endpoint catalog, held in memory and refreshed from the API in the background when it's stale.
 
+    The loop keeps getting the current endpoints while a refresh runs, and gets the new ones once it has completed.
+    The request URLs are added to the endpoints as a new catalog is taken in. Each catalog is saved to the cache
+    file, written to a temporary file and renamed over the cache file so that a crash can't leave it half written,
+    and the cache file is loaded at startup so that the monitor starts with the last known endpoints.
+    """
 
-# TODO: clean up cache handling
-def load_from_flask_api(rpc_endpoint_db_url: str, cache_filename: str, cache_refresh_interval: int) -> list:
-    """Load endpoints from cache or refresh if cache is stale."""
-    # Load cached values from file
-    try:
-        with open(cache_filename, "r", encoding="utf-8") as f:
-            results, last_cache_refresh = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        logger.warning("Could not load values from %s", cache_filename)
-        results, last_cache_refresh = None, 0
-
-    # Check if cache is stale
-    if time.time() - last_cache_refresh > cache_refresh_interval:
-        refresh_cache = True
-    else:
-        diff = time.time() - last_cache_refresh
-        remains = cache_refresh_interval - diff
-        logger.info("%s will be updated in: %s seconds", cache_filename, round(remains, 1))
-        refresh_cache = False
-
-    if refresh_cache:
+    def __init__(self, catalog: "CatalogClient", url_rewriter: "UrlRewriter", cache_filename: str, max_age: int):
+        self.catalog = catalog
+        self.url_rewriter = url_rewriter
+        self.cache_file = Path(cache_filename)
+        self.max_age = max_age
+        self.endpoints = []
+        self.index = {}
+        self.refreshed = 0
+        self.refresh_thread = None
         try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                endpoints, refreshed = json.load(f)
+            self.update(endpoints, refreshed)
+            logger.info("Loaded %s endpoints from %s", len(self.endpoints), self.cache_file)
+        except (FileNotFoundError, json.JSONDecodeError, ValueError, TypeError):
+            logger.warning("Could not load values from %s", self.cache_file)
+
+    def get(self) -> list:
+        """Return the current endpoints, starting a background refresh if they're stale.
+
+        Without any endpoints yet, the refresh is waited for.
+        """
+        if time.time() - self.refreshed > self.max_age and not self.refreshing:
             logger.info("Updating cache from Flask API")
-            results = get_all_endpoints(rpc_endpoint_db_url)
-            last_cache_refresh = time.time()
-            # Save updated cache to file
-            with open(cache_filename, "w", encoding="utf-8") as f:
-                json.dump((results, last_cache_refresh), f)
+            self.refresh_thread = threading.Thread(target=self.refresh, name="endpoint-cache-refresh", daemon=True)
+            self.refresh_thread.start()
+        if not self.endpoints and self.refreshing:
+            self.refresh_thread.join()
+        return self.endpoints
+
+    @property
+    def refreshing(self) -> bool:
+        """Whether a refresh is running."""
+        return self.refresh_thread is not None and self.refresh_thread.is_alive()
+
+    def refresh(self) -> None:
+        """Fetch the catalog from the API, take it in and save it to the cache file."""
+        try:
+            endpoints = self.catalog.get_all_endpoints()
+            refreshed = time.time()
+            self.update(endpoints, refreshed)
+            self.save(endpoints, refreshed)
+            logger.info("Cache updated with %s endpoints", len(self.endpoints))
         except Exception as e:
-            # Log the error
+            # The current endpoints are kept, and the refresh is retried on the next get
             logger.error("An error occurred while updating cache: %s", str(e))
-            # Load the previous cache value
-            with open(cache_filename, "r", encoding="utf-8") as f:
-                results, last_cache_refresh = json.load(f)
-    else:
-        logger.info("Using cached values")
-    return results
-
-
-def get_all_endpoints(rpc_endpoint_db_url: str) -> list:
-    """Return a list of endpoint tuples on the form (<chain>, <URL>, <API class>)."""
-    # TODO: make return a dict instead?
-    endpoint_tuples = []
-    all_chains = requests.get(f"{rpc_endpoint_db_url}/all/chains", timeout=3)
-    for chain in all_chains.json():
-        chain_info = requests.get(f'{rpc_endpoint_db_url}/chain_info?chain_name={chain["name"]}', timeout=1)
-        for url in chain_info.json()["urls"]:
-            endpoint_tuples.append((chain_info.json()["chain_name"], url, chain_info.json()["api_class"]))
-    return endpoint_tuples
-
-
-def block_height_request_point(
-    chain: str, url: str, data: dict, block_height_diff: int, timestamp: datetime, http_code: str
-) -> Point:
-    """Define and return a block height request point measurement for the database."""
-    time_total = float(data.get("time_total")) if data.get("time_total") else REQUEST_TIMEOUT / 1000.0
-    latest_block_height = int(data.get("latest_block_height")) if data.get("latest_block_height") else None
-
-    point = (
-        Point("block_height_request").tag("chain", chain).tag("url", url).field("http_code", http_code).time(timestamp)
+
+    def update(self, endpoints: list, refreshed: float) -> None:
+        """Take in a catalog of (<chain>, <URL>, <API class>) endpoints, adding their request URLs.
+
+        The endpoint list is only replaced if the catalog has changed, so that the loop can tell a changed catalog
+        from an unchanged one by the identity of the list.
+        """
+        index = index_endpoints(self.url_rewriter.add_request_urls(endpoints))
+        added, removed = diff_endpoints(self.index, index)
+        if added or removed:
+            changed = len({endpoint[:2] for endpoint in added} & {endpoint[:2] for endpoint in removed})
+            logger.info(
+                "Endpoint catalog changed: %s added, %s removed, %s changed",
+                len(added) - changed,
+                len(removed) - changed,
+                changed,
+            )
+            self.index = index
+            self.endpoints = list(index.values())
+        self.refreshed = refreshed
+
+    def save(self, endpoints: list, refreshed: float) -> None:
+        """Write the catalog to the cache file atomically."""
+        temp_file = self.cache_file.with_name(f".{self.cache_file.name}.tmp")
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump((endpoints, refreshed), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.cache_file)
+
+    def close(self, timeout: float = REQUEST_TIMEOUT / 1000.0) -> None:
+        """Wait for a running refresh to complete, up to 'timeout' seconds."""
+        if self.refreshing:
+            self.refresh_thread.join(timeout)
+
+
+def index_endpoints(endpoints: list) -> dict:
+    """Key the endpoint tuples by their identity, the (<chain>, <URL>) pair."""
+    return {(endpoint[0], endpoint[1]): tuple(endpoint) for endpoint in endpoints}
+
+
+def diff_endpoints(previous: dict, current: dict) -> tuple[list, list]:
+    """Diff two endpoint indexes, returns the endpoints added and the endpoints removed.
+
+    An endpoint whose API class or request URL has changed is both removed, as it was, and added, as it is now.
+    """
+    added = [endpoint for key, endpoint in current.items() if previous.get(key) != endpoint]
+    removed = [endpoint for key, endpoint in previous.items() if current.get(key) != endpoint]
+    return added, removed
+
+
+class CatalogClient:
+    """Fetch the endpoint catalog from the RPC endpoint API over a pooled session.
+
+    The chain infos are fetched concurrently, up to 'concurrency' at a time. With 'bulk', they're first requested
+    from the bulk route in one request, falling back to the chain info requests if that fails or its response isn't
+    a list of chain infos. Responses with an ETag or Last-Modified header are kept and revalidated with
+    If-None-Match / If-Modified-Since, so that unchanged chain infos are neither sent nor parsed again.
+    """
+
+    def __init__(self, rpc_endpoint_db_url: str, concurrency: int = CATALOG_REFRESH_CONCURRENCY, bulk: bool = False):
+        self.rpc_endpoint_db_url = rpc_endpoint_db_url
+        self.bulk = bulk
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="catalog")
+        self.responses = {}
+
+    def get_json(self, path: str, timeout: float) -> object:
+        """Get and parse a JSON response from the API, revalidating the response kept from an earlier request."""
+        url = self.rpc_endpoint_db_url + path
+        headers = {}
+        validators, body = self.responses.get(url, ({}, None))
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+        response = self.session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and validators:
+            return body
+        response.raise_for_status()
+        body = response.json()
+        validators = {key: response.headers[key] for key in ["ETag", "Last-Modified"] if key in response.headers}
+        if validators:
+            self.responses[url] = (validators, body)
+        else:
+            self.responses.pop(url, None)
+        return body
+
+    def get_all_endpoints(self) -> list:
+        """Return a list of endpoint tuples on the form (<chain>, <URL>, <API class>)."""
+        chain_infos = self.get_bulk_chain_infos() if self.bulk else None
+        paths = [CATALOG_BULK_PATH]
+        if chain_infos is None:
+            chains = self.get_json("/all/chains", timeout=3)
+            paths = [f'/chain_info?chain_name={quote(chain["name"])}' for chain in chains]
+            chain_infos = list(self.executor.map(lambda path: self.get_json(path, timeout=1), paths))
+            paths = paths + ["/all/chains", CATALOG_BULK_PATH]
+        # Forget the kept responses of chains that are gone
+        urls = {self.rpc_endpoint_db_url + path for path in paths}
+        self.responses = {url: response for url, response in self.responses.items() if url in urls}
+        endpoint_tuples = []
+        for chain_info in chain_infos:
+            for url in chain_info["urls"]:
+                endpoint_tuples.append((chain_info["chain_name"], url, chain_info["api_class"]))
+        return endpoint_tuples
+
+    def get_bulk_chain_infos(self) -> list:
+        """Get the chain infos of all chains in one request, returns None if that fails."""
+        try:
+            chain_infos = self.get_json(CATALOG_BULK_PATH, timeout=3)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("Bulk catalog request failed, requesting the chains one by one, error: [%s]", e)
+            return None
+        if not isinstance(chain_infos, list) or not all(is_chain_info(info) for info in chain_infos):
+            logger.warning("Bulk catalog response isn't a list of chain infos, requesting the chains one by one")
+            return None
+        return chain_infos
+
+    def close(self) -> None:
+        """Stop the fetching threads and close the session."""
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+def is_chain_info(chain_info: object) -> bool:
+    """Check that a chain info has the chain name, URLs and API class the endpoints are made of."""
+    return (
+        isinstance(chain_info, dict)
+        and isinstance(chain_info.get("chain_name"), str)
+        and isinstance(chain_info.get("urls"), list)
+        and isinstance(chain_info.get("api_class"), str)
     )
-    if isinstance(block_height_diff, int):
-        point = point.field("block_height_diff", block_height_diff)
-    if isinstance(latest_block_height, int):
-        point = point.field("block_height", latest_block_height)
-    if time_total:
-        point = point.field("request_time_total", time_total)
-    return point
+
+
+class ResultTable:
+    """The results of a loop, held in preallocated typed array columns with a row per endpoint.
+
+    The rows are assigned when the endpoints are set, and a row's index is its endpoint's id. Chains are interned
+    to chain ids. Results are written into their endpoint's row as they arrive, overwriting any earlier result in
+    the loop, so that the aggregation and serialization run over the columns instead of a dict per result.
+
+    An http_code of 0 marks a row without a result, a block_height of 0 a result without a block height, and a
+    time_total of 0.0 a result without a request time. The configured request telemetry fields get a column each,
+    with has_telemetry marking the rows whose result came with telemetry. The throttled and circuit_open columns mark
+    the rows of rate limited and unreachable endpoints.
+    """
+
+    def __init__(self, telemetry_fields: list = ()):
+        self.endpoints = []
+        self.rows = {}
+        self.chains = []
+        self.size = 0
+        self.chain_id = array("l")
+        self.http_code = array("l")
+        self.block_height = array("q")
+        self.time_total = array("d")
+        self.subscription = array("b")
+        self.throttled = array("b")
+        self.circuit_open = array("b")
+        self.telemetry = {field: array(REQUEST_TELEMETRY_FIELDS[field][1]) for field in telemetry_fields}
+        self.has_telemetry = array("b")
+        self.empty_columns = []
+
+    @property
+    def result_columns(self) -> tuple:
+        """The columns written by the results."""
+        return (
+            self.http_code,
+            self.block_height,
+            self.time_total,
+            self.subscription,
+            self.throttled,
+            self.circuit_open,
+            self.has_telemetry,
+            *self.telemetry.values(),
+        )
+
+    def set_endpoints(self, endpoints: list) -> None:
+        """Assign the rows to the endpoints, growing the columns if needed."""
+        self.endpoints = [tuple(endpoint) for endpoint in endpoints]
+        self.rows = {(chain, url): row for row, (chain, url, *_) in enumerate(self.endpoints)}
+        self.size = len(self.endpoints)
+        for column in (self.chain_id, *self.result_columns):
+            if len(column) < self.size:
+                column.extend(array(column.typecode, bytes(column.itemsize * (self.size - len(column)))))
+        chain_ids = {}
+        for row, (chain, *_) in enumerate(self.endpoints):
+            self.chain_id[row] = chain_ids.setdefault(chain, len(chain_ids))
+        self.chains = list(chain_ids)
+        self.empty_columns = [
+            array(column.typecode, bytes(column.itemsize * len(column))) for column in self.result_columns
+        ]
+
+    def clear(self) -> None:
+        """Clear the results of the previous loop."""
+        for column, empty in zip(self.result_columns, self.empty_columns):
+            column[:] = empty
+
+    def set(
+        self,
+        chain: str,
+        url: str,
+        http_code: int,
+        block_height: int,
+        time_total: float,
+        subscription: bool = False,
+        telemetry: dict = None,
+        throttled: bool = False,
+        circuit_open: bool = False,
+    ) -> None:
+        """Write a result into its endpoint's row, ignoring endpoints that aren't in the table."""
+        row = self.rows.get((chain, url))
+        if row is None:
+            return
+        # The same http_code for failed requests as before the table, where None or 0 were reported as -2
+        self.http_code[row] = http_code or -2
+        self.block_height[row] = int(block_height) if block_height else 0
+        self.time_total[row] = float(time_total) if time_total else 0.0
+        self.subscription[row] = subscription
+        self.throttled[row] = throttled
+        self.circuit_open[row] = circuit_open
+        self.has_telemetry[row] = bool(telemetry and self.telemetry)
+        if telemetry:
+            for field, column in self.telemetry.items():
+                column[row] = telemetry[field]
+
+    def add(self, result: dict) -> None:
+        """Write a probe engine's result into its endpoint's row."""
+        self.set(
+            result["chain"],
+            result["url"],
+            result["http_code"],
+            result["latest_block_height"],
+            result["time_total"],
+            telemetry=result.get("telemetry"),
+            throttled=result.get("throttled", False),
+            circuit_open=result.get("circuit_open", False),
+        )
+
+
+def aggregate_block_heights(table: ResultTable, lag_threshold: int) -> dict:
+    """Compute the max block height of every chain, and every result's lag behind it, over the result table.
+
+    The rows with a block height are sorted by chain id, so that the chain maxima are one reduceat over the chain
+    segments, which is broadcast back to the rows as their lag. As summary stats, the number of endpoints with a
+    block height, their median lag and the fraction of them lagging at most 'lag_threshold' blocks are computed per
+    chain.
+
+    return - A dict with the 'rows' holding a result and the 'lags' of all rows, -1 for rows without a block height,
+    and per chain its 'chain_ids', 'max_heights', 'counts', 'median_lags' and 'within_threshold' fractions
+    """
+    aggregation = {
+        "rows": [],
+        "lags": [],
+        "chain_ids": [],
+        "max_heights": [],
+        "counts": [],
+        "median_lags": [],
+        "within_threshold": [],
+    }
+    size = table.size
+    if not size:
+        return aggregation
+    http_codes = np.frombuffer(table.http_code, dtype=table.http_code.typecode, count=size)
+    block_heights = np.frombuffer(table.block_height, dtype=table.block_height.typecode, count=size)
+    chain_ids = np.frombuffer(table.chain_id, dtype=table.chain_id.typecode, count=size)
+    lags = np.full(size, -1, dtype=np.int64)
+    aggregation["rows"] = np.flatnonzero(http_codes).tolist()
+
+    rows = np.flatnonzero((http_codes != 0) & (block_heights > 0))
+    if len(rows):
+        rows = rows[np.argsort(chain_ids[rows], kind="stable")]
+        row_chain_ids = chain_ids[rows]
+        row_heights = block_heights[rows]
+        starts = np.flatnonzero(np.r_[True, row_chain_ids[1:] != row_chain_ids[:-1]])
+        counts = np.diff(np.r_[starts, len(rows)])
+        max_heights = np.maximum.reduceat(row_heights, starts)
+        row_lags = np.repeat(max_heights, counts) - row_heights
+        lags[rows] = row_lags
+        # The lags sorted within their chain segments, for the medians
+        row_lags = row_lags[np.lexsort((row_lags, np.repeat(np.arange(len(starts)), counts)))]
+        median_lags = (row_lags[starts + (counts - 1) // 2] + row_lags[starts + counts // 2]) / 2
+        within_threshold = np.add.reduceat((row_lags <= lag_threshold).astype(np.int64), starts) / counts
+        aggregation["chain_ids"] = row_chain_ids[starts].tolist()
+        aggregation["max_heights"] = max_heights.tolist()
+        aggregation["counts"] = counts.tolist()
+        aggregation["median_lags"] = median_lags.tolist()
+        aggregation["within_threshold"] = within_threshold.tolist()
+    aggregation["lags"] = lags.tolist()
+    return aggregation
+
+
+class LineProtocolSerializer:
+    """Serialize block height request measurements straight to InfluxDB line protocol.
+
+    Lines are written into one reusable buffer, without building a Point per record. The escaped measurement and
+    tag set of every chain/url pair is cached across loops, and timestamps are in seconds ('s') or milliseconds
+    ('ms') as set by 'precision'. The request telemetry fields are added to the request lines with telemetry.
+    """
+
+    MEASUREMENT = b"block_height_request"
+    SUMMARY_MEASUREMENT = b"chain_block_height_summary"
+    CONCURRENCY_MEASUREMENT = b"probe_concurrency"
+    DNS_MEASUREMENT = b"dns_resolution"
+    MAX_CACHED_SERIES = 100000
+
+    def __init__(self, precision: str = "s", telemetry_fields: list = ()):
+        if precision not in LINE_PROTOCOL_PRECISIONS:
+            raise ValueError("Invalid line protocol precision:", precision)
+        self.precision = precision
+        # The formats of the telemetry fields, floats as they are and integers with the integer suffix
+        self.telemetry_formats = [
+            b",%s=%%%s" % (field.encode(), b"r" if REQUEST_TELEMETRY_FIELDS[field][1] == "d" else b"di")
+            for field in telemetry_fields
+        ]
+        self.buffer = bytearray()
+        self.series = {}
+        self.timestamp = b"\n"
+        self.count = 0
+
+    def start(self, timestamp: float) -> None:
+        """Clear the buffer, and set the timestamp of the lines written next."""
+        self.buffer.clear()
+        self.timestamp = b" %d\n" % int(timestamp * LINE_PROTOCOL_PRECISIONS[self.precision])
+        self.count = 0
+
+    def get_series(self, chain: str, url: str) -> bytes:
+        """Get the escaped measurement and tag set for a chain/url pair, followed by a space."""
+        series = self.series.get((chain, url))
+        if series is None:
+            if len(self.series) >= self.MAX_CACHED_SERIES:
+                self.series.clear()
+            series = b"%s,chain=%s,url=%s " % (self.MEASUREMENT, escape_tag(chain), escape_tag(url))
+            self.series[(chain, url)] = series
+        return series
+
+    def add_request(
+        self,
+        chain: str,
+        url: str,
+        http_code: int,
+        block_height: int,
+        block_height_diff: int,
+        time_total: float,
+        subscription: bool,
+        telemetry: list = None,
+        throttled: bool = False,
+        circuit_open: bool = False,
+    ) -> None:
+        """Write a block height request line for an endpoint's result, a block height of 0 meaning none.
+
+        'telemetry' - the values of the telemetry fields, in the order they were configured, if any
+        'throttled' - whether the endpoint is rate limited, if so without a request time it was held back unrequested
+        'circuit_open' - whether the endpoint's request was held back by its open circuit
+        """
+        # Held back requests weren't sent, so there is no request time to report either
+        requested = not subscription and not circuit_open and not (throttled and not time_total)
+        time_total = time_total or REQUEST_TIMEOUT / 1000.0
+
+        buffer = self.buffer
+        buffer += self.get_series(chain, url)
+        buffer += b"http_code=%di" % http_code
+        if isinstance(block_height_diff, int):
+            buffer += b",block_height_diff=%di" % block_height_diff
+        if block_height:
+            buffer += b",block_height=%di" % block_height
+        # Block heights from subscriptions weren't requested, so there is no request time to report
+        if requested:
+            buffer += b",request_time_total=%r" % time_total
+        if throttled:
+            buffer += b",throttled=true"
+        if circuit_open:
+            buffer += b",circuit_open=true"
+        if telemetry:
+            for field_format, value in zip(self.telemetry_formats, telemetry):
+                buffer += field_format % value
+        buffer += self.timestamp
+        self.count = self.count + 1
+
+    def add_max(self, chain: str, max_height: int) -> None:
+        """Write the max block height line of a chain."""
+        # 'zzz' to sort it last, is removed in Grafana
+        self.buffer += self.get_series(chain, "zzz - Max over time")
+        self.buffer += b"block_height=%di" % max_height
+        self.buffer += self.timestamp
+        self.count = self.count + 1
+
+    def add_chain_summary(self, chain: str, count: int, median_lag: float, within_threshold: float) -> None:
+        """Write the summary line of a chain's block height lags."""
+        self.buffer += b"%s,chain=%s " % (self.SUMMARY_MEASUREMENT, escape_tag(chain))
+        self.buffer += b"endpoints=%di,median_block_height_diff=%r,within_lag_threshold=%r" % (
+            count,
+            median_lag,
+            within_threshold,
+        )
+        self.buffer += self.timestamp
+        self.count = self.count + 1
+
+    def add_concurrency(self, concurrency: int) -> None:
+        """Write the line of the number of requests the monitor allows in flight."""
+        self.buffer += b"%s limit=%di" % (self.CONCURRENCY_MEASUREMENT, concurrency)
+        self.buffer += self.timestamp
+        self.count = self.count + 1
+
+    def add_host_resolution(self, host: str, num_addresses: int) -> None:
+        """Write the DNS health line of a host, from the outcome of its latest lookup."""
+        self.buffer += b"%s,host=%s " % (self.DNS_MEASUREMENT, escape_tag(host))
+        self.buffer += b"resolved=%s,addresses=%di" % (b"true" if num_addresses else b"false", num_addresses)
+        self.buffer += self.timestamp
+        self.count = self.count + 1
+
+    def getvalue(self) -> bytes:
+        """Get the lines written since the last start."""
+        return bytes(self.buffer)
+
+
+def escape_tag(value: str) -> bytes:
+    """Escape a tag value for line protocol."""
+    return value.translate(LINE_PROTOCOL_TAG_ESCAPES).encode("utf-8")
+
+
+def split_endpoints_by_scheme(endpoints: list) -> tuple[list, list]:
+    """Split the endpoint tuples into one list of http endpoints and one list of websocket endpoints."""
+    http_endpoints, ws_endpoints = [], []
+    for endpoint in endpoints:
+        if is_ws_url(endpoint[1]):
+            ws_endpoints.append(endpoint)
+        else:
+            http_endpoints.append(endpoint)
+    return http_endpoints, ws_endpoints
 
 
 def is_http_url(url: str) -> bool:
@@ -346,94 +918,130 @@ def is_valid_url(url: str, valid_schemes: list) -> bool:
     return parsed_url.scheme in valid_schemes
 
 
-def get_json_rpc_method(api_class: str) -> str:
-    """Get the JSON-RPC method for the API class."""
-    if api_class == "substrate":
-        return "chain_getHeader"
-    if api_class == "ethereum":
-        return "eth_blockNumber"
-    if api_class == "starknet":
-        return "starknet_blockNumber"
-    if api_class == "filecoin":
-        return "Filecoin.ChainHead"
-    if api_class == "sui":
-        return "sui_getLatestCheckpointSequenceNumber"
-    if api_class == "ton":
-        return "getMasterchainInfo"
-    raise ValueError("Invalid api_class:", api_class)
-
-
-def get_block_height_diff(diffs: dict, chain: str, url: str) -> int:
-    """Get the block height difference for a specific chain and URL."""
-    if chain not in diffs.keys():
-        return None
-    if url not in diffs[chain].keys():
-        return None
-    return diffs[chain][url]
+class ApiClass:
+    """How the block height of an API class is requested and read, compiled once from its registry entry.
+
+    The request body and the JSON-RPC request template are encoded up front, and the block height is read from a
+    response by walking the registered paths, trying them in order.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        method: str = "POST",
+        json_rpc_method: str = None,
+        height_paths: list = None,
+        height_base: int = 10,
+        headers: list = None,
+        error_field: str = "error",
+        head_subscription: dict = None,
+    ):
+        if method not in ["GET", "POST"]:
+            raise ValueError(f"Invalid method for api_class {name}:", method)
+        if method == "POST" and not json_rpc_method:
+            raise ValueError(f"No json_rpc_method for POST api_class {name}")
+        if not height_paths:
+            raise ValueError(f"No height_paths for api_class {name}")
+        self.name = name
+        self.method = method
+        self.json_rpc_method = json_rpc_method
+        self.headers = headers or (GET_HEADERS if method == "GET" else POST_HEADERS)
+        self.header_dict = split_headers(self.headers)
+        # The JSON-RPC request with a placeholder for the request id
+        self.request_template = None
+        if json_rpc_method:
+            self.request_template = '{"method": %s, "params": [], "id": %%d, "jsonrpc": "2.0"}' % json.dumps(
+                json_rpc_method
+            )
+        self.body = self.get_request(1).encode("utf-8") if method == "POST" else None
+        self.height_paths = [tuple(path) for path in height_paths]
+        self.height_fields = frozenset(path[0] for path in self.height_paths)
+        self.height_base = height_base
+        self.error_field = error_field
+        self.head_subscription = head_subscription
+
+    def get_request(self, request_id: int) -> str:
+        """Get the JSON-RPC block height request with the request id."""
+        if not self.request_template:
+            raise ValueError(f"No json_rpc_method for api_class {self.name}")
+        return self.request_template % request_id
+
+    def get_block_height(self, response: dict) -> int:
+        """Get the block height at the first of the height paths found in the response."""
+        error = None
+        for path in self.height_paths:
+            try:
+                value = response
+                for key in path:
+                    value = value[key]
+                return int(value, self.height_base) if isinstance(value, str) else int(value)
+            except (KeyError, IndexError, TypeError) as e:
+                error = e
+        raise error
+
+
+# The API class registry, loaded from API_CLASSES_FILE at startup
+API_CLASSES = {}
+
+
+def load_api_classes(path: Path) -> dict:
+    """Load and compile the API class registry from a YAML file."""
+    with open(path, encoding="utf-8") as f:
+        entries = yaml.safe_load(f)
+    return {name: ApiClass(name, **entry) for name, entry in entries.items()}
+
+
+def get_api_class(api_class: str) -> ApiClass:
+    """Get the registered API class."""
+    try:
+        return API_CLASSES[api_class]
+    except KeyError:
+        raise ValueError("Invalid api_class:", api_class) from None
 
 
 def get_highest_block(api_class: str, response: dict) -> int:
     """Get the highest block number from the response."""
     try:
-        if api_class == "substrate":
-            return int(response["result"]["number"], 16)
-        if api_class == "ethereum":
-            return int(response["result"], 16)
-        if api_class == "starknet":
-            return int(response["result"])
-        if api_class == "filecoin":
-            return int(response["result"]["Height"])
-        if api_class == "sui":
-            return int(response["result"])
-        if api_class == "waves":
-            return int(response["height"])
-        if api_class == "ton":
-            return int(response["result"]["last"]["seqno"])
-        if api_class == "tonv3":
-            return int(response["last"]["seqno"])
-        if api_class == "sidecar":
-            return int(response["number"])
-        if api_class == "cosmos-tendermint":
-            try:
-                return int(response["block"]["header"]["height"])
-            except Exception:
-                return int(response["result"]["sync_info"]["latest_block_height"])
-        if api_class == "eos":
-            return int(response["head_block_num"])
-        if api_class == "eth-v1-beacon":
-            return int(response["data"][0]["header"]["message"]["slot"])
-        if api_class == "tron":
-            return int(response["block_header"]["raw_data"]["number"])
-        if api_class == "movement":
-            return int(response["block_height"])
+        return get_api_class(api_class).get_block_height(response)
     except Exception as e:
         logger.error(f"{e.__class__.__name__} for api_class: [{api_class}], response: [{response}], %s", e)
         raise e
-    raise ValueError("Invalid api_class:", api_class)
-
-
-def validate_response(response: dict) -> bool:
-    """Validate the presence of select fields in the response dict."""
-    valid_fields = [
-        "result",
-        "height",
-        "number",
-        "block",
-        "head_block_num",
-        "data",
-        "block_header",
-        "block_height",
-        "last",
-    ]
-    for field in valid_fields:
-        if field in response.keys():
-            return True
-    if "error" in response.keys():
-        # TODO: catch codes here? e.g. 'code': -32004 for hitting daily relay limit
-        logger.error("Error in request response: %s", response["error"])
+
+
+def validate_response(api_class: str, response: dict) -> bool:
+    """Validate the presence of the fields the API class' block height is read from in the response dict."""
+    api = get_api_class(api_class)
+    if not api.height_fields.isdisjoint(response.keys()):
+        return True
+    if api.error_field in response.keys():
+        logger.error("Error in request response: %s", response[api.error_field])
     return False
 
 
+def is_quota_error(response: dict) -> bool:
+    """Check if a response is a JSON-RPC error for a hit rate limit or quota, see JSON_RPC_QUOTA_ERRORS."""
+    error = response.get("error") if isinstance(response, dict) else None
+    return isinstance(error, dict) and error.get("code") in JSON_RPC_QUOTA_ERRORS
+
+
+def parse_retry_after(value: str) -> float:
+    """Parse a Retry-After header, in seconds or an HTTP date, into seconds. Returns None if missing or invalid."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def prune_response(body: bytes) -> str:
+    """Get the start of a response body for logging."""
+    body = body.decode("utf-8", errors="replace") if isinstance(body, (bytes, bytearray)) else str(body)
+    return body[:512] + "..." if len(body) > 512 else body
+
+
 def parse_error_code(message: str) -> int:
     """Parse the error code from a message."""
     match = re.search(r"\d+", message)
@@ -442,15 +1050,260 @@ def parse_error_code(message: str) -> int:
     return -1
 
 
-def write_to_influxdb(url: str, token: str, org: str, bucket: str, records: list) -> None:
-    """Write to the InfluxDB."""
-    try:
-        client = InfluxDBClient(url=url, token=token, org=org)
-        write_api = client.write_api(write_options=SYNCHRONOUS)
-        write_api.write(bucket=bucket, record=records)
-    except Exception as e:
-        logger.critical("Failed writing to influx. %s", str(e))
-        sys.exit(1)
+class ResultSpool:
+    """An append-only, on-disk spool of line protocol records, split into segment files.
+
+    Records are appended to the active segment, which is rotated when it reaches 'segment_size' bytes, or when
+    it's read from while no other segments are waiting. Closed segments are read oldest first and deleted once
+    written to InfluxDB. When the spool grows past 'max_size' bytes, the oldest segments are evicted.
+
+    The fsync policy is one of 'always' (after every append), 'segment' (when a segment is closed) or 'never'.
+    The timestamp precision of the records is kept in the segment file names, so that segments spooled with
+    another precision are still replayed correctly.
+    """
+
+    def __init__(
+        self, directory: Path, max_size: int, segment_size: int, fsync: str = "segment", precision: str = "s"
+    ):
+        if fsync not in ["always", "segment", "never"]:
+            raise ValueError("Invalid spool fsync policy:", fsync)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.precision = precision
+        self.lock = threading.Lock()
+        # Segments left from an earlier run are replayed first
+        self.segments = sorted(self.directory.glob("*.*.lp"))
+        if self.segments:
+            logger.info("Found %s spooled segments in %s", len(self.segments), self.directory)
+        self.sequence = int(self.segments[-1].name.split(".")[0]) + 1 if self.segments else 0
+        self.active = None
+        self.active_path = None
+
+    def append(self, data: bytes) -> None:
+        """Append newline terminated line protocol records to the active segment."""
+        with self.lock:
+            if self.active is None:
+                self.active_path = self.directory / f"{self.sequence:012d}.{self.precision}.lp"
+                self.sequence = self.sequence + 1
+                self.active = open(self.active_path, "ab")
+            self.active.write(data)
+            self.active.flush()
+            if self.fsync == "always":
+                os.fsync(self.active.fileno())
+            if self.active.tell() >= self.segment_size:
+                self.rotate()
+            self.evict()
+
+    def rotate(self) -> None:
+        """Close the active segment, making it available for reading."""
+        if self.active is None:
+            return
+        if self.fsync == "segment":
+            os.fsync(self.active.fileno())
+        self.active.close()
+        self.segments.append(self.active_path)
+        self.active, self.active_path = None, None
+
+    def evict(self) -> None:
+        """Delete the oldest closed segments while the spool is larger than its max size."""
+        sizes = {path: path.stat().st_size for path in self.segments if path.exists()}
+        total_size = sum(sizes.values()) + (self.active.tell() if self.active else 0)
+        evicted = 0
+        while self.segments and total_size > self.max_size:
+            path = self.segments.pop(0)
+            total_size = total_size - sizes.get(path, 0)
+            path.unlink(missing_ok=True)
+            evicted = evicted + 1
+        if evicted:
+            logger.warning("Spool in %s over its max size, evicted %s oldest segments", self.directory, evicted)
+
+    def read_batch(self, max_lines: int) -> tuple[bytes, int, str, list]:
+        """Read whole segments of the same precision, oldest first, up to 'max_lines' lines but at least one segment.
+
+        return - The records read, their number and precision, and the segments they were read from, to be
+        committed once written
+        """
+        with self.lock:
+            if not self.segments:
+                self.rotate()
+            chunks, num_lines, precision, segments = [], 0, None, []
+            for path in list(self.segments):
+                if segments and num_lines >= max_lines:
+                    break
+                segment_precision = path.suffixes[0][1:]
+                if segments and segment_precision != precision:
+                    break
+                try:
+                    data = path.read_bytes()
+                except FileNotFoundError:
+                    self.segments.remove(path)
+                    continue
+                chunks.append(data)
+                num_lines = num_lines + data.count(b"\n")
+                precision = segment_precision
+                segments.append(path)
+            return b"".join(chunks), num_lines, precision, segments
+
+    def commit(self, segments: list) -> None:
+        """Delete segments that have been written to InfluxDB."""
+        with self.lock:
+            for path in segments:
+                if path in self.segments:
+                    self.segments.remove(path)
+                path.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        """Close the active segment."""
+        with self.lock:
+            self.rotate()
+
+
+class InfluxWriter:
+    """Write line protocol records to InfluxDB in batches from a background thread.
+
+    Payloads of records are put on a bounded in-memory queue, dropping the oldest payloads when it holds more than
+    'queue_size' records, and written in gzipped batches of around 'batch_size' records every 'flush_interval'
+    seconds. Failed writes are retried with jittered exponential backoff, keeping the records on the queue, so
+    that InfluxDB being briefly unavailable doesn't stall or stop the monitor. Batches InfluxDB rejects for good,
+    see is_rejected_write(), are dropped instead, so that they don't block the writes behind them.
+
+    With a ResultSpool, the records are appended to the spool on disk instead of the in-memory queue, and the
+    writer thread drains the spool. Records then survive longer InfluxDB outages and restarts of the monitor, and
+    the backlog built up during an outage is caught up with in large batches.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: str,
+        org: str,
+        bucket: str,
+        batch_size: int = 5000,
+        flush_interval: float = 1.0,
+        queue_size: int = 100000,
+        precision: str = "s",
+        spool: ResultSpool = None,
+    ):
+        self.bucket = bucket
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.precision = precision
+        self.spool = spool
+        self.client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=True)
+        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        # Queued payloads, with the number of records in each
+        self.queue = deque()
+        self.queued = 0
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="influxdb-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, payload: bytes, num_records: int) -> None:
+        """Queue a payload of newline terminated line protocol records to be written."""
+        if not payload:
+            return
+        if self.spool:
+            self.spool.append(payload)
+            return
+        with self.condition:
+            self.queue.append((payload, num_records))
+            self.queued = self.queued + num_records
+            self.trim_queue()
+            if self.queued >= self.batch_size:
+                self.condition.notify()
+
+    def trim_queue(self) -> None:
+        """Drop the oldest payloads while the queue holds more than its max number of records."""
+        overflow = 0
+        while len(self.queue) > 1 and self.queued > self.queue_size:
+            _, num_records = self.queue.popleft()
+            self.queued = self.queued - num_records
+            overflow = overflow + num_records
+        if overflow:
+            self.dropped = self.dropped + overflow
+            logger.warning("InfluxDB write queue full, dropping %s oldest records", overflow)
+
+    def take_batch(self) -> tuple[list, str, list]:
+        """Take the next batch of payloads to write, their precision, and the spool segments holding them."""
+        if self.spool:
+            data, num_lines, precision, segments = self.spool.read_batch(self.batch_size)
+            return [(data, num_lines)] if data else [], precision, segments
+        with self.condition:
+            batch, num_records = [], 0
+            while self.queue and (not batch or num_records + self.queue[0][1] <= self.batch_size):
+                batch.append(self.queue.popleft())
+                num_records = num_records + batch[-1][1]
+            self.queued = self.queued - num_records
+            return batch, self.precision, []
+
+    def run(self) -> None:
+        """Write the queued records in batches until stopped."""
+        failures = 0
+        while True:
+            with self.condition:
+                if not self.stopped and self.queued < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                stopped = self.stopped
+            batch, precision, segments = self.take_batch()
+            if not batch:
+                if stopped:
+                    return
+                continue
+            try:
+                self.write_api.write(
+                    bucket=self.bucket, record=b"".join(payload for payload, _ in batch), write_precision=precision
+                )
+                failures = 0
+                self.commit_batch(segments)
+            except Exception as e:
+                if is_rejected_write(e):
+                    self.dropped = self.dropped + sum(num_records for _, num_records in batch)
+                    logger.error("InfluxDB rejected a batch of records, dropping it. %s", str(e))
+                    self.commit_batch(segments)
+                    continue
+                failures = failures + 1
+                self.requeue_batch(batch)
+                backoff = min(INFLUXDB_RETRY_BACKOFF * 2 ** (failures - 1), INFLUXDB_RETRY_MAX_BACKOFF)
+                backoff = backoff * random.uniform(0.5, 1.0)
+                logger.error("Failed writing to influx, retrying in %.1fs. %s", backoff, str(e))
+                if stopped:
+                    return
+                time.sleep(backoff)
+
+    def commit_batch(self, segments: list) -> None:
+        """Delete the spool segments of a batch that is done with, if the records are spooled."""
+        if self.spool:
+            self.spool.commit(segments)
+
+    def requeue_batch(self, batch: list) -> None:
+        """Put a batch to retry back in front of the queue, within the queue's bounds, if the records are queued."""
+        if self.spool:
+            return
+        with self.condition:
+            self.queue.extendleft(reversed(batch))
+            self.queued = self.queued + sum(num_records for _, num_records in batch)
+            self.trim_queue()
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Flush the queued records and stop the writer thread."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join(timeout)
+        if self.spool:
+            self.spool.close()
+        self.client.close()
+
+
+def is_rejected_write(error: Exception) -> bool:
+    """Whether a write failed with a client error, other than a timeout or rate limit, that a retry would get too."""
+    return isinstance(error, ApiException) and error.status in range(400, 500) and error.status not in [408, 429]
 
 
 def get_handle() -> pycurl.Curl:
@@ -458,6 +1311,7 @@ def get_handle() -> pycurl.Curl:
     c = pycurl.Curl()
     c.setopt(pycurl.TIMEOUT_MS, REQUEST_TIMEOUT)  # Set a timeout for the request
     c.setopt(pycurl.NOSIGNAL, 1)  # Disable signals for multi-threaded applications
+    c.setopt(pycurl.TCP_KEEPALIVE, 1)  # Keep idle connections alive between monitor loops
     return c
 
 
@@ -466,79 +1320,81 @@ def get_result(c: pycurl.Curl, block_height: int = None, http_code: int = None)
 
     c - The Curl object
     block_height - Override parameter, usually from using websocket
-    http_code - Override parameter, usually from using websocket
+    http_code - Override parameter, usually from a failed transfer
 
-    return - A dict with info for the database
+    return - A dict with info for the database, with the handle's telemetry fields under 'telemetry' if it has any
     """
     total_time = c.getinfo(pycurl.TOTAL_TIME)
-    # Time measurements available if needed:
-    # dns_time = c.getinfo(pycurl.NAMELOOKUP_TIME)
-    # connect_time = c.getinfo(pycurl.CONNECT_TIME)
-    # pretransfer_time = c.getinfo(pycurl.PRETRANSFER_TIME)
-    # starttransfer_time = c.getinfo(pycurl.STARTTRANSFER_TIME)
+    # The phase timings and byte counts, see REQUEST_TELEMETRY_FIELDS
+    telemetry = {field: c.getinfo(info) for field, info in c.telemetry} or None
 
     if not http_code:
         http_code = c.getinfo(pycurl.HTTP_CODE)
-
-    trimmed_url = c.url.replace("/12345678-f359-43a8-89aa-3219a362396f", "")
+    # Parsed by curl from the header, in seconds, 0 if there was none
+    retry_after = (c.getinfo(pycurl.RETRY_AFTER) or None) if http_code in [429, 503] else None
 
     if not block_height:
-        response_json = c.response_buffer.getvalue().decode("utf-8")
+        # Parsed straight from the handle's reused response buffer, without decoding it to a str first
         try:
-            response_dict = json.loads(response_json)
-            block_height = get_highest_block(c.api_class, response_dict) if validate_response(response_dict) else None
-        except (json.JSONDecodeError, TypeError) as e:
-            pruned_response = response_json[:512] + "..." if len(response_json) > 512 else response_json
+            response_dict = loads_json(c.response_buffer)
+            if validate_response(c.api_class, response_dict):
+                block_height = get_highest_block(c.api_class, response_dict)
+            elif is_quota_error(response_dict):
+                http_code = 429
+        except (json.JSONDecodeError, TypeError, KeyError, IndexError, ValueError) as e:
+            pruned_response = prune_response(c.response_buffer)
             logger.warning(
                 "%s for request to [%s] with response: [%s], http_code: [%s], error: [%s]",
                 e.__class__.__name__,
-                c.getinfo(pycurl.EFFECTIVE_URL),
+                c.display_url,
                 pruned_response,
                 http_code,
                 e,
             )
             return {
                 "chain": c.chain,
-                "url": trimmed_url,
+                "url": c.display_url,
                 # "http_code": parse_error_code(response_json) if "error code:" in str(response_json) else None,
                 "http_code": http_code,
                 "latest_block_height": None,
                 "time_total": None,
+                "telemetry": telemetry,
+                "retry_after": retry_after,
             }
         except AttributeError:
             logger.warning(
                 "AttributeError for request to [%s] with response: [%s], http_code: [%s]",
-                trimmed_url,
-                response_json,
+                c.display_url,
+                prune_response(c.response_buffer),
                 http_code,
             )
             return {
                 "chain": c.chain,
-                "url": trimmed_url,
+                "url": c.display_url,
                 "http_code": http_code,
                 "latest_block_height": None,
                 "time_total": total_time,
+                "telemetry": telemetry,
+                "retry_after": retry_after,
             }
 
     return {
         "chain": c.chain,
-        "url": trimmed_url,
+        "url": c.display_url,
         "http_code": http_code,
         "time_total": total_time,
         "latest_block_height": block_height,
+        "telemetry": telemetry,
+        "retry_after": retry_after,
     }
 
 
-def make_ws_request(url: str, api_class: str, timeout: int = WS_TIMEOUT) -> tuple[int, int]:
-    """Make a websocket request to the URL and return the block height and HTTP code."""
+def make_ws_request(url: str, api_class: str, pool: "WsConnectionPool") -> tuple[int, int]:
+    """Make a websocket request to the URL through the pool and return the block height and HTTP code."""
     try:
-        ws = websocket.create_connection(url, timeout=timeout)
-        ws.settimeout(timeout)
-        data = json.dumps({"method": get_json_rpc_method(api_class), "params": [], "id": 1, "jsonrpc": "2.0"})
-        ws.send(data)
-        response = json.loads(ws.recv())
-        block_height = get_highest_block(api_class, response) if validate_response(response) else None
-        http_code = 200
+        response = pool.request(url, get_api_class(api_class))
+        block_height = get_highest_block(api_class, response) if validate_response(api_class, response) else None
+        http_code = 429 if block_height is None and is_quota_error(response) else 200
     except (websocket._exceptions.WebSocketTimeoutException, socket.timeout) as e:
         logger.error("WebSocketTimeoutException for URL [%s], error: [%s]", url, e)
         block_height = None
@@ -551,161 +1407,1518 @@ def make_ws_request(url: str, api_class: str, timeout: int = WS_TIMEOUT) -> tupl
         logger.error("Error for URL [%s], error: [%s]", url, e)
         block_height = None
         http_code = 500
-    finally:
-        ws.close()
     return block_height, http_code
 
 
-# TODO: rename after cleanup
-def fetch_results_pycurl(endpoints: list, num_connections: int = 4) -> list:
-    """Make a block height request to all URL:s in the 'endpoints' list, returns a list of the results.
+class ReconnectBackoff:
+    """Track the failures of a connection and when it may be reconnected, with exponential backoff."""
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = None
+
+    def delay(self) -> float:
+        """Return the time left (seconds) until a reconnection may be attempted."""
+        return max(self.retry_at - time.monotonic(), 0.0) if self.last_error is not None else 0.0
+
+    def check(self) -> None:
+        """Raise the error that closed the connection if it's still too early to reconnect."""
+        if self.last_error is not None and time.monotonic() < self.retry_at:
+            raise self.last_error.with_traceback(None)
+
+    def failed(self, error: Exception) -> None:
+        """Register a failed connection and schedule the next reconnection attempt."""
+        self.failures = self.failures + 1
+        self.last_error = error
+        backoff = min(WS_RECONNECT_BACKOFF * 2 ** (self.failures - 1), WS_RECONNECT_MAX_BACKOFF)
+        self.retry_at = time.monotonic() + backoff
+
+    def succeeded(self) -> None:
+        """Register a successful request, resetting the backoff."""
+        self.failures = 0
+        self.last_error = None
+
+
+class WsConnection:
+    """A persistent websocket connection that JSON-RPC requests are made over, one at a time."""
 
-    'endpoints' - list of tuples (<chain>, <URL>, <API class>)
-    'return' - list of dicts
+    def __init__(self, url: str, timeout: float = WS_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.ws = None
+        self.lock = threading.Lock()
+        self.backoff = ReconnectBackoff()
+
+    def request(self, request_id: int, api: ApiClass) -> dict:
+        """Send the API class' JSON-RPC block height request and return the response with the matching id.
+
+        A request failing on a reused connection, other than by timing out, is sent once more over a new one.
+        """
+        with self.lock:
+            try:
+                reused = self.ws is not None
+                try:
+                    response = self.exchange(request_id, api)
+                except Exception as e:
+                    if not reused or isinstance(e, (websocket._exceptions.WebSocketTimeoutException, socket.timeout)):
+                        raise
+                    logger.debug("Websocket for URL [%s] failed, reconnecting, error: [%s]", self.url, e)
+                    self.close()
+                    response = self.exchange(request_id, api)
+            except Exception as e:
+                if e is not self.backoff.last_error:
+                    self.close()
+                    self.backoff.failed(e)
+                raise
+            self.backoff.succeeded()
+            return response
+
+    def exchange(self, request_id: int, api: ApiClass) -> dict:
+        """Send the request, connecting first if there is no connection, and receive its response."""
+        if self.ws is None:
+            self.backoff.check()
+            self.ws = websocket.create_connection(self.url, timeout=self.timeout)
+        self.ws.send(api.get_request(request_id))
+        return self.receive(request_id)
+
+    def receive(self, request_id: int) -> dict:
+        """Receive messages until the response to the request arrives, dropping replies to earlier requests."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise websocket._exceptions.WebSocketTimeoutException("No response to request id %s" % request_id)
+            self.ws.settimeout(remaining)
+            message = loads_json(self.ws.recv())
+            if isinstance(message, dict) and message.get("id") == request_id:
+                return message
+
+    def close(self) -> None:
+        """Close the websocket, if open."""
+        if self.ws:
+            try:
+                self.ws.close()
+            except Exception as e:
+                logger.debug("Error while closing websocket for URL [%s], error: [%s]", self.url, e)
+        self.ws = None
+
+
+class WsConnectionPool:
+    """Keep one persistent websocket connection per URL for the block height requests.
+
+    Each request gets a unique JSON-RPC id and the reply is matched on that id. A connection that fails is closed,
+    and requests to that URL fail fast with the same error until the reconnection backoff has passed.
     """
-    # TODO: if error 1010 pops up again, try rotating user agents per https://www.scrapehero.com/how-to-fake-and-rotate-user-agents-using-python-3/
-    get_headers = [
-        "Connection: keep-alive",
-        "Keep-Alive: timeout=4, max=10",
-        "User-Agent: Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/118.0",
-    ]
-    post_headers = [
-        "Connection: keep-alive",
-        "Keep-Alive: timeout=4, max=10",
-        "Content-Type: application/json",
-        "User-Agent: Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/118.0",
-    ]
-    queue = endpoints.copy()
-    cm = pycurl.CurlMulti()
-    cm.handles = []
-    num_requests = len(queue)
-    num_conn = min(num_connections, num_requests)
-    for _ in range(0, num_conn):
-        cm.handles.append(get_handle())
-    # Main loop
-    freelist = cm.handles[:]
-    num_processed = 0
-    results = []
-    while num_processed < num_requests:
-        # If there is an url to process and a free curl object, add to multi stack
-        while queue and freelist:  # and "queue" of URL:s
-            chain, url, api_class = queue.pop()
-            c = freelist.pop()
-            c.api_class = api_class
-            c.chain = chain
-            if "api-" in url and "dwellir" in url:
-                if "avalanche" in url:
-                    # URL like api-avalanche-mainnet-archive.dwellir.com/ext/bc/C/rpc
-                    url = url.replace("/ext/bc/C/rpc", "/12345678-f359-43a8-89aa-3219a362396f/ext/bc/C/rpc")
-                elif "filecoin" in url:
-                    # URL like api-filecoin-mainnet.dwellir.com/rpc/v1
-                    url = url.replace("/rpc/v1", "/12345678-f359-43a8-89aa-3219a362396f/rpc/v1")
-                elif "waves" in url:
-                    # URL like api-polkadot-sidecar.dwellir.com/blocks/head/header
-                    url = url.replace("/blocks/height", "/12345678-f359-43a8-89aa-3219a362396f/blocks/height")
-                elif "ton" == api_class:
-                    # URL like api-ton-mainnet-archive.n.dwellir.com/api/v2/jsonRPC
-                    url = url.replace("/api/v2/jsonRPC", "/12345678-f359-43a8-89aa-3219a362396f/api/v2/jsonRPC")
-                elif "tonv3" == api_class:
-                    # URL like api-ton-mainnet-archive.n.dwellir.com/api/v3/masterchainInfo
-                    url = url.replace("/api/v3/masterchainInfo", "/12345678-f359-43a8-89aa-3219a362396f/api/v3/masterchainInfo")
-                elif "sidecar" in url:
-                    # URL like api-polkadot-sidecar.dwellir.com/blocks/head/header
-                    url = url.replace("/blocks/head/header", "/12345678-f359-43a8-89aa-3219a362396f/blocks/head/header")
-                elif "cosmos/base/tendermint" in url:
-                    # URL like api-celestia-mainnet-full.n.dwellir.com/cosmos/base/tendermint/v1beta1/blocks/latest
-                    url = url.replace(
-                        "/cosmos/base/tendermint/v1beta1/blocks/latest",
-                        "/12345678-f359-43a8-89aa-3219a362396f/cosmos/base/tendermint/v1beta1/blocks/latest",
-                    )
-                elif "celestia" in url and "status" in url:
-                    # URL like api-celestia-mainnet-full.n.dwellir.com/cosmos/base/tendermint/v1beta1/blocks/latest
-                    url = url.replace(
-                        "/status",
-                        "/12345678-f359-43a8-89aa-3219a362396f/status",
-                    )
-                elif "wallet/getnowblock" in url:
-                    # URL like api-tron-mainnet.n.dwellir.com/wallet/getnowblock
-                    url = url.replace(
-                        "/wallet/getnowblock",
-                        "/12345678-f359-43a8-89aa-3219a362396f/wallet/getnowblock",
-                    )
-                elif "movement" in api_class and "v1" in url:
-                    # URL like api-movement-mainnet.n.dwellir.com/v1
-                    url = url.replace(
-                        "/v1",
-                        "/12345678-f359-43a8-89aa-3219a362396f/v1",
-                    )
-                else:
-                    url = url + "/12345678-f359-43a8-89aa-3219a362396f"
-            c.url = url
-            c.setopt(pycurl.URL, url)  # may actually come from separate list "queue"
-            c.response_buffer = BytesIO()
-            c.setopt(pycurl.WRITEDATA, c.response_buffer)
-            if api_class in HTTP_GET_APIS:
-                c.setopt(pycurl.HTTPHEADER, get_headers)
-                c.setopt(pycurl.HTTPGET, 1)
-            else:
-                c.setopt(pycurl.HTTPHEADER, post_headers)
-                c.setopt(pycurl.POST, 1)
-                data = json.dumps({"method": get_json_rpc_method(api_class), "params": [], "id": 1, "jsonrpc": "2.0"})
-                c.setopt(pycurl.POSTFIELDS, data)
-            cm.add_handle(c)
+
+    def __init__(self, timeout: float = WS_TIMEOUT):
+        self.timeout = timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+
+    def request(self, url: str, api: ApiClass) -> dict:
+        """Make the API class' JSON-RPC request over the connection to the URL and return the response."""
+        with self.lock:
+            if url not in self.connections:
+                self.connections[url] = WsConnection(url, self.timeout)
+            connection = self.connections[url]
+            request_id = next(self.request_ids)
+        return connection.request(request_id, api)
+
+    def remove(self, url: str) -> None:
+        """Close the connection to a URL that is no longer in use, if open."""
+        with self.lock:
+            connection = self.connections.pop(url, None)
+        if connection:
+            connection.close()
+
+    def close(self) -> None:
+        """Close all connections in the pool."""
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for connection in connections.values():
+            connection.close()
+
+
+def get_ws_result(pool: WsConnectionPool, chain: str, url: str, api_class: str, request_url: str) -> dict:
+    """Get the block height request result for a websocket endpoint."""
+    time_start = time.perf_counter()
+    block_height, http_code = make_ws_request(request_url, api_class, pool)
+    return {
+        "chain": chain,
+        "url": url,
+        "http_code": http_code,
+        "time_total": time.perf_counter() - time_start if http_code == 200 else None,
+        "latest_block_height": block_height,
+    }
+
+
+class UrlRewriter:
+    """Rewrite the endpoint URLs into the URLs requested, by an ordered table of rules from the config.
+
+    A rule matches URLs containing all of its 'contains' substrings, and, if set, endpoints of its 'api_class'. The
+    first matching rule inserts the API key into the URL in front of its 'path', or appends it to the URL if the rule
+    has no path. URLs no rule matches are requested as they are. The request URLs are worked out when the endpoints
+    are loaded, and remembered while the endpoints stay in the catalog.
+    """
+
+    def __init__(self, rules: list, api_key: str):
+        self.rules = [(tuple(rule.get("contains", [])), rule.get("api_class"), rule.get("path")) for rule in rules]
+        self.api_key = api_key
+        self.request_urls = {}
+
+    def rewrite(self, url: str, api_class: str) -> str:
+        """Get the request URL of an endpoint."""
+        if not self.api_key:
+            return url
+        for contains, rule_api_class, path in self.rules:
+            if rule_api_class and rule_api_class != api_class:
+                continue
+            if all(part in url for part in contains):
+                if path:
+                    return url.replace(path, f"/{self.api_key}{path}")
+                return f"{url}/{self.api_key}"
+        return url
+
+    def add_request_urls(self, endpoints: list) -> list:
+        """Return the endpoints as (<chain>, <URL>, <API class>, <request URL>) tuples."""
+        request_urls = {}
+        for _, url, api_class in endpoints:
+            if (url, api_class) not in request_urls:
+                request_url = self.request_urls.get((url, api_class)) or self.rewrite(url, api_class)
+                request_urls[(url, api_class)] = request_url
+        self.request_urls = request_urls
+        return [(chain, url, api_class, request_urls[(url, api_class)]) for chain, url, api_class in endpoints]
+
+
+class HeadSubscription(threading.Thread):
+    """Keep a newHeads subscription open to a websocket endpoint and report new heads to a HeadTracker."""
+
+    def __init__(self, tracker: "HeadTracker", endpoint: tuple):
+        super().__init__(name=f"head-subscription-{endpoint[1]}", daemon=True)
+        self.tracker = tracker
+        self.endpoint = endpoint
+        self.connection = None
+        self.stopped = threading.Event()
+        self.backoff = ReconnectBackoff()
+
+    def run(self) -> None:
+        """Listen for new heads, reconnecting with backoff if the connection fails."""
+        while not self.stopped.wait(self.backoff.delay()):
+            try:
+                self.listen()
+            except Exception as e:
+                if not self.stopped.is_set():
+                    logger.warning("Head subscription for URL [%s] failed, error: [%s]", self.endpoint[1], e)
+                    self.backoff.failed(e)
+            finally:
+                self.tracker.discard(self.endpoint)
+                self.close()
+
+    def listen(self) -> None:
+        """Subscribe to new heads over a websocket and update the tracker as they arrive."""
+        _, _, api_class, request_url = self.endpoint
+        head_subscription = get_api_class(api_class).head_subscription
+        method, params = head_subscription["method"], head_subscription.get("params", [])
+        self.connection = websocket.create_connection(request_url, timeout=WS_TIMEOUT)
+        self.connection.send(json.dumps({"method": method, "params": params, "id": 1, "jsonrpc": "2.0"}))
+        # A connected but silent socket is considered dead after the timeout
+        self.connection.settimeout(HEAD_SUBSCRIPTION_TIMEOUT)
+        while not self.stopped.is_set():
+            message = loads_json(self.connection.recv())
+            if message.get("id") == 1 and "error" in message:
+                raise ValueError(f"Subscription with {method} failed: {message['error']}")
+            head = message.get("params", {}).get("result")
+            if isinstance(head, dict) and "number" in head:
+                self.tracker.update(self.endpoint, int(head["number"], 16))
+                self.backoff.succeeded()
+
+    def stop(self) -> None:
+        """Stop the subscription, closing the connection to interrupt a waiting receive."""
+        self.stopped.set()
+        self.close()
+
+    def close(self) -> None:
+        """Close the connection, if open."""
+        connection, self.connection = self.connection, None
+        if connection:
+            try:
+                connection.close()
+            except Exception as e:
+                logger.debug("Error while closing connection for URL [%s], error: [%s]", self.endpoint[1], e)
+
+
+class BeaconHeadSubscription(HeadSubscription):
+    """Follow the head events of an eth-v1-beacon endpoint over Server-Sent Events and report the slots."""
+
+    def listen(self) -> None:
+        """Stream the head events over one long-lived HTTP connection and update the tracker as they arrive."""
+        events_url = get_beacon_events_url(self.endpoint[3])
+        self.connection = requests.get(
+            events_url,
+            headers={"Accept": "text/event-stream"},
+            stream=True,
+            timeout=(WS_TIMEOUT, HEAD_SUBSCRIPTION_TIMEOUT),
+        )
+        self.connection.raise_for_status()
+        event, data = None, []
+        for line in self.connection.iter_lines(chunk_size=None, decode_unicode=True):
+            if self.stopped.is_set():
+                return
+            if line.startswith("event:"):
+                event = line[len("event:") :].strip()
+            elif line.startswith("data:"):
+                data.append(line[len("data:") :].strip())
+            elif not line:
+                # A blank line dispatches the event
+                if event == "head" and data:
+                    self.tracker.update(self.endpoint, int(loads_json("\n".join(data))["slot"]))
+                    self.backoff.succeeded()
+                event, data = None, []
+        raise ConnectionError("Event stream closed by the server")
+
+
+class HeadTracker:
+    """Track the latest block height of endpoints through head subscriptions.
+
+    Websocket endpoints of the API classes with a head_subscription are followed with newHeads subscriptions, and
+    eth-v1-beacon endpoints with their head event stream. The table of latest heights is updated by the subscription
+    threads as heads arrive, and the monitor loop reads a snapshot of it instead of requesting the block height from
+    the subscribed endpoints. Endpoints whose subscription is down, or hasn't delivered a head yet, are left to be
+    requested as usual.
+
+    The version is bumped whenever an endpoint enters or leaves the table, so that the loop only has to partition
+    the endpoints again when the set of tracked endpoints has changed.
+    """
+
+    def __init__(self):
+        self.heads = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.subscriptions = {}
+
+    def sync(self, endpoints: list) -> None:
+        """Start subscriptions for new endpoints and stop those of removed endpoints."""
+        index = index_endpoints(endpoints)
+        added, removed = diff_endpoints(self.endpoints, index)
+        self.endpoints = index
+        for endpoint in removed:
+            subscription = self.subscriptions.pop(endpoint, None)
+            if subscription:
+                subscription.stop()
+                self.discard(endpoint)
+        for endpoint in added:
+            subscription_type = get_head_subscription_type(*endpoint)
+            if subscription_type:
+                self.subscriptions[endpoint] = subscription_type(self, endpoint)
+                self.subscriptions[endpoint].start()
+
+    def update(self, endpoint: tuple, block_height: int) -> None:
+        """Set the latest block height of an endpoint."""
+        with self.lock:
+            if endpoint not in self.heads:
+                self.version = self.version + 1
+            self.heads[endpoint] = block_height
+
+    def discard(self, endpoint: tuple) -> None:
+        """Remove an endpoint from the table, e.g. when its subscription is down."""
+        with self.lock:
+            if self.heads.pop(endpoint, None) is not None:
+                self.version = self.version + 1
+
+    def snapshot(self) -> dict:
+        """Return a copy of the table of latest block heights."""
+        with self.lock:
+            return dict(self.heads)
+
+    def partition(self, endpoints: list) -> tuple[list, list]:
+        """Split the endpoints into those with a tracked head, and those left to request."""
+        heads = self.snapshot()
+        tracked, remaining = [], []
+        for endpoint in endpoints:
+            (tracked if tuple(endpoint) in heads else remaining).append(endpoint)
+        return tracked, remaining
+
+    def add_results(self, table: ResultTable, endpoints: list) -> None:
+        """Write the latest tracked block heights of the endpoints into the result table."""
+        heads = self.snapshot()
+        for endpoint in endpoints:
+            chain, url, *_ = endpoint
+            block_height = heads.get(tuple(endpoint))
+            if block_height is None:
+                continue
+            table.set(chain, url, 200, block_height, None, subscription=True)
+
+    def close(self) -> None:
+        """Stop all subscriptions."""
+        self.sync([])
+
+
+def get_head_subscription_type(chain: str, url: str, api_class: str, request_url: str) -> type:
+    """Return the HeadSubscription class that can follow the endpoint, or None if it can't be followed."""
+    if is_ws_url(url) and api_class in API_CLASSES and API_CLASSES[api_class].head_subscription:
+        return HeadSubscription
+    if is_http_url(url) and api_class == "eth-v1-beacon":
+        return BeaconHeadSubscription
+    return None
+
+
+class HostResolver:
+    """Resolve the hostnames of the HTTP endpoints ahead of the requests, in the background.
+
+    Addresses are kept for 'ttl' seconds, and failed lookups are retried after DNS_FAILURE_TTL seconds, a host whose
+    lookup fails keeping its last addresses. The outcome of every host's latest lookup is kept in 'results'.
+    """
+
+    def __init__(self, ttl: float, concurrency: int = CATALOG_REFRESH_CONCURRENCY):
+        self.ttl = ttl
+        self.hosts = set()
+        self.expires = {}
+        self.results = {}
+        self.resolves = {}
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="dns")
+        self.refresh_thread = None
+
+    def set_hosts(self, hosts: set) -> None:
+        """Set the hosts to resolve, forgetting those that are gone."""
+        self.hosts = hosts
+        if any(host not in hosts for host in self.results):
+            self.results = {host: result for host, result in self.results.items() if host in hosts}
+            self.resolves = {host: addresses for host, addresses in self.resolves.items() if host in hosts}
+
+    def refresh(self) -> None:
+        """Start resolving the new and expired hosts in the background, unless a refresh is already running."""
+        if self.refresh_thread is not None and self.refresh_thread.is_alive():
+            return
+        now = time.monotonic()
+        hosts = [host for host in self.hosts if self.expires.get(host, 0) <= now]
+        if hosts:
+            self.refresh_thread = threading.Thread(target=self.resolve, args=(hosts,), name="dns-refresh", daemon=True)
+            self.refresh_thread.start()
+
+    def resolve(self, hosts: list) -> None:
+        """Resolve the hosts, and swap in the updated results and addresses."""
+        results = dict(zip(hosts, self.executor.map(resolve_host, hosts)))
+        now = time.monotonic()
+        for host, addresses in results.items():
+            self.expires[host] = now + (self.ttl if addresses else DNS_FAILURE_TTL)
+        self.results = {host: result for host, result in {**self.results, **results}.items() if host in self.hosts}
+        resolves = dict(self.resolves)
+        resolves.update({host: addresses for host, addresses in results.items() if addresses})
+        resolves = {host: addresses for host, addresses in resolves.items() if host in self.hosts}
+        if resolves != self.resolves:
+            self.resolves = resolves
+        failed = [host for host, addresses in results.items() if not addresses]
+        logger.info("Resolved %s hosts, %s failed", len(results) - len(failed), len(failed))
+
+    def close(self, timeout: float = REQUEST_TIMEOUT / 1000.0) -> None:
+        """Stop the lookup threads, waiting up to 'timeout' seconds for a running refresh to complete."""
+        if self.refresh_thread is not None:
+            self.refresh_thread.join(timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def resolve_host(host: str) -> tuple:
+    """Look up the addresses of a host, returns an empty tuple if the lookup failed."""
+    try:
+        infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as e:
+        logger.warning("Could not resolve host [%s], error: [%s]", host, e)
+        return ()
+    return tuple(dict.fromkeys(info[4][0] for info in infos))
+
+
+def get_http_hosts(endpoints: list) -> set:
+    """Get the hostnames of the HTTP endpoints' request URLs, leaving out IP addresses."""
+    hosts = set()
+    for _, url, _, request_url in endpoints:
+        if is_http_url(url):
+            host = urlparse(request_url).hostname
+            if host and not is_ip_address(host):
+                hosts.add(host)
+    return hosts
+
+
+def is_ip_address(host: str) -> bool:
+    """Check if a host is an IP address rather than a hostname."""
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def get_beacon_events_url(url: str) -> str:
+    """Get the head event stream URL of the beacon node serving the URL."""
+    base_url = url.split("/eth/v1/")[0].rstrip("/")
+    return base_url + BEACON_EVENTS_PATH
+
+
+class ProbeEngine:
+    """Interface for the engines making the block height requests.
+
+    Endpoint tuples (<chain>, <URL>, <API class>, <request URL>) are submitted to an engine, which makes the
+    requests concurrently, and the results are collected by polling the engine. Each result is a dict on the form
+    returned by get_result(), i.e. with the keys 'chain', 'url', 'http_code', 'time_total' and 'latest_block_height'.
+
+    The engine is told about the endpoints by syncing it with the endpoint lists. Only the changes are applied, so
+    the connections and other state held for the unchanged endpoints are kept.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+
+    def sync(self, http_endpoints: list, ws_endpoints: list) -> tuple[list, list]:
+        """Update the engine with the current endpoint lists, returns the endpoints added and removed."""
+        index = index_endpoints(http_endpoints + ws_endpoints)
+        added, removed = diff_endpoints(self.endpoints, index)
+        if added or removed:
+            self.update_endpoints(added, removed)
+        self.endpoints = index
+        return added, removed
+
+    def update_endpoints(self, added: list, removed: list) -> None:
+        """Release what is held for the removed endpoints, and prepare for the added ones."""
+        raise NotImplementedError
+
+    def set_concurrency(self, num_connections: int) -> None:
+        """Set the number of requests kept in flight, requests over the limit wait for a free slot."""
+        raise NotImplementedError
+
+    def set_resolves(self, resolves: dict) -> None:
+        """Set the resolved addresses of the hosts, a dict of hostname to a tuple of addresses."""
+        raise NotImplementedError
+
+    def submit(self, endpoint: tuple) -> None:
+        """Start a block height request to an endpoint."""
+        raise NotImplementedError
+
+    def poll(self, timeout: float) -> list:
+        """Wait up to 'timeout' seconds for requests to complete, returns a list of the results of those that did."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release the resources held by the engine."""
+
+
+class CurlProbeEngine(ProbeEngine):
+    """Make block height requests through a long-lived pycurl multi stack.
+
+    The multi and share handles and one Curl handle per endpoint are kept between loops, so that the connections
+    are reused. The connections to a host are capped at 'max_host_connections' (0 for no cap), and with 'http2' the
+    requests to a host are multiplexed over one connection. Websocket requests run on a thread pool over a
+    WsConnectionPool.
+    """
+
+    def __init__(
+        self, num_connections: int = 4, max_host_connections: int = 0, http2: bool = False, telemetry_fields: list = ()
+    ):
+        super().__init__()
+        self.num_connections = num_connections
+        self.http2 = http2
+        self.telemetry = [(field, REQUEST_TELEMETRY_FIELDS[field][0]) for field in telemetry_fields]
+        self.resolves = {}
+        self.num_http_endpoints = 0
+        self.ws_executor = ThreadPoolExecutor(max_workers=num_connections, thread_name_prefix="ws-probe")
+        self.ws_pool = WsConnectionPool()
+        self.ws_futures = set()
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, max_host_connections)
+        self.multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX if http2 else pycurl.PIPE_NOTHING)
+        self.handles = {}
+        self.queue = deque()
+        self.in_flight = set()
+
+    def get_endpoint_handle(self, endpoint: tuple) -> pycurl.Curl:
+        """Return the Curl handle for an endpoint, creating and configuring it on first use."""
+        c = self.handles.get(endpoint)
+        if c:
+            return c
+        chain, url, api_class, request_url = endpoint
+        c = get_handle()
+        c.setopt(pycurl.SHARE, self.share)
+        c.api_class = api_class
+        c.chain = chain
+        c.url = request_url
+        c.display_url = url
+        c.telemetry = self.telemetry
+        c.setopt(pycurl.URL, c.url)
+        parsed_url = urlparse(request_url)
+        c.host = parsed_url.hostname
+        c.port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+        c.pinned = None
+        # HTTP/2 is only negotiated over TLS, plain HTTP requests mustn't wait for a connection to multiplex on
+        if self.http2 and parsed_url.scheme == "https":
+            c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+            c.setopt(pycurl.PIPEWAIT, 1)
+        c.response_buffer = bytearray()
+        c.setopt(pycurl.WRITEFUNCTION, c.response_buffer.extend)
+        api = get_api_class(api_class)
+        c.setopt(pycurl.HTTPHEADER, api.headers)
+        if api.method == "GET":
+            c.setopt(pycurl.HTTPGET, 1)
+        else:
+            c.setopt(pycurl.POST, 1)
+            c.setopt(pycurl.POSTFIELDS, api.body)
+        self.handles[endpoint] = c
+        return c
+
+    def update_endpoints(self, added: list, removed: list) -> None:
+        """Close the handles and websockets of the removed endpoints, the handles of new ones are made on first use."""
+        for endpoint in removed:
+            if is_ws_url(endpoint[1]):
+                self.ws_pool.remove(endpoint[3])
+                continue
+            self.num_http_endpoints = self.num_http_endpoints - 1
+            c = self.handles.pop(endpoint, None)
+            if c is None:
+                continue
+            if c in self.in_flight:
+                self.multi.remove_handle(c)
+                self.in_flight.discard(c)
+            if c in self.queue:
+                self.queue.remove(c)
+            c.close()
+        self.num_http_endpoints = self.num_http_endpoints + sum(1 for endpoint in added if not is_ws_url(endpoint[1]))
+        # Let the multi handle keep one open connection per endpoint between loops
+        self.multi.setopt(pycurl.M_MAXCONNECTS, max(self.num_http_endpoints, self.num_connections))
+
+    def set_resolves(self, resolves: dict) -> None:
+        """Set the resolved addresses of the hosts, pinned into the handles as they're started."""
+        self.resolves = resolves
+
+    def pin_addresses(self, c: pycurl.Curl) -> None:
+        """Pin the resolved addresses of the handle's host, if they changed since they were last pinned."""
+        addresses = self.resolves.get(c.host)
+        if addresses is c.pinned:
+            return
+        host_port = f"{c.host}:{c.port}"
+        # Remove the earlier entry from the shared DNS cache first, so that it's replaced or left to curl
+        resolve = [f"-{host_port}"]
+        if addresses:
+            resolve.append(f"{host_port}:" + ",".join(f"[{a}]" if ":" in a else a for a in addresses))
+        c.setopt(pycurl.RESOLVE, resolve)
+        c.pinned = addresses
+
+    def set_concurrency(self, num_connections: int) -> None:
+        """Set the number of handles in the multi stack, starting queued requests if slots were added."""
+        self.num_connections = num_connections
+        self.multi.setopt(pycurl.M_MAXCONNECTS, max(self.num_http_endpoints, self.num_connections))
+        self.start_queued()
+
+    def submit(self, endpoint: tuple) -> None:
+        """Queue a block height request to an endpoint, starting it if there is a free connection slot."""
+        if is_ws_url(endpoint[1]):
+            self.ws_futures.add(self.ws_executor.submit(get_ws_result, self.ws_pool, *endpoint))
+            return
+        self.queue.append(self.get_endpoint_handle(tuple(endpoint)))
+        self.start_queued()
+
+    def start_queued(self) -> None:
+        """Add queued handles to the multi stack while there are free connection slots."""
+        while self.queue and len(self.in_flight) < self.num_connections:
+            c = self.queue.popleft()
+            c.response_buffer.clear()
+            self.pin_addresses(c)
+            self.multi.add_handle(c)
+            self.in_flight.add(c)
+
+    def poll(self, timeout: float) -> list:
+        """Wait up to 'timeout' seconds for requests to complete, returns a list of the results of those that did."""
+        results = self.read_completed()
+        if results or timeout <= 0:
+            return results
+        if self.in_flight:
+            # Wake up regularly to also pick up the websocket results
+            self.multi.select(min(timeout, 0.05) if self.ws_futures else timeout)
+        elif self.ws_futures:
+            wait(self.ws_futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        else:
+            time.sleep(timeout)
+        return self.read_completed()
+
+    def read_completed(self) -> list:
+        """Run the multi stack and return the results of the requests that have completed."""
+        results = []
         # Run the internal curl state machine for the multi stack
         while True:
-            ret, num_handles = cm.perform()
+            ret, _ = self.multi.perform()
             if ret != pycurl.E_CALL_MULTI_PERFORM:
                 break
-        # Check for curl objects which have terminated, and add them to the freelist
+        # Check for curl objects which have terminated, and free their slots
         while True:
-            num_q, ok_list, err_list = cm.info_read()
+            num_q, ok_list, err_list = self.multi.info_read()
             for c in ok_list:
                 results.append(get_result(c))
-                c.api_class = ""
-                c.chain = ""
-                c.url = ""
-                cm.remove_handle(c)
-                # logger.debug("Successful curl for URL: [%s]", c.getinfo(pycurl.EFFECTIVE_URL))
-                freelist.append(c)
+                self.multi.remove_handle(c)
+                self.in_flight.discard(c)
             for c, errno, errmsg in err_list:
                 logger.debug("Failed curl for URL: [%s], err-num: [%s], err-msg: [%s].", c.url, errno, errmsg)
-                retry_block_height, retry_http_code = None, None
-                # TODO: implement a better way of handling websockets, this is only a "retry if fail"
-                if errno == 1 and "wss" in errmsg:
-                    logger.debug("Trying websocket connection because of error: %s", errmsg)
-                    try:
-                        retry_block_height, retry_http_code = make_ws_request(c.url, c.api_class)
-                    except Exception as e:
-                        # TODO: downgrade log from error when selecting specific Exception/s to use
-                        # TODO: use "if 429 in e:" to log a too many requests response
-                        logger.error("Failed WS connection for URL: [%s], error [%s]", url, e)
-                elif errno == 6:
-                    logger.debug("Could not resolve host for URL: [%s]", url)
-                    retry_http_code = 404  # HTTP status code for Not Found
-                elif errno == 7:
-                    logger.debug("No route to host for URL: [%s]", url)
-                    retry_http_code = 404  # HTTP status code for Not Found
-                elif errno == 28:
-                    logger.debug("Connection timed out for URL: [%s]", url)
-                    retry_http_code = 408  # HTTP status code for Request Timeout
-                results.append(get_result(c, retry_block_height, retry_http_code))
-                c.api_class = ""
-                c.chain = ""
-                c.url = ""
-                cm.remove_handle(c)
-                freelist.append(c)
-            num_processed = num_processed + len(ok_list) + len(err_list)
+                retry_http_code, reason = UNREACHABLE_CURL_ERRORS.get(errno, (None, None))
+                if reason:
+                    logger.debug("%s for URL: [%s]", reason, c.url)
+                result = get_result(c, http_code=retry_http_code)
+                # The endpoint couldn't be reached at all, see CircuitBreaker
+                result["unreachable"] = retry_http_code is not None
+                results.append(result)
+                self.multi.remove_handle(c)
+                self.in_flight.discard(c)
             if num_q == 0:
                 break
-        # Currently no more I/O is pending, could do something in the meantime
-        # (display a progress bar, etc.).
-        # We just call select() to sleep until some more data is available.
-        cm.select(0.2)
-    # Cleanup
-    for c in cm.handles:
-        c.close()
-    cm.close()
-    return results
+        self.start_queued()
+        for future in [f for f in self.ws_futures if f.done()]:
+            self.ws_futures.discard(future)
+            results.append(future.result())
+        return results
+
+    def close(self) -> None:
+        """Close all handles held by the engine."""
+        for c in self.in_flight:
+            self.multi.remove_handle(c)
+        self.in_flight = set()
+        self.queue = deque()
+        for c in self.handles.values():
+            c.close()
+        self.handles = {}
+        self.multi.close()
+        self.share.close()
+        self.ws_executor.shutdown(wait=False, cancel_futures=True)
+        self.ws_pool.close()
+
+
+class AsyncioProbeEngine(ProbeEngine):
+    """Make block height requests as coroutines on a single asyncio event loop.
+
+    HTTP GET, JSON-RPC POST and websocket requests all run on the same loop, limited only by the concurrency
+    limit, so a slow websocket request doesn't hold up the HTTP requests. Requests over the limit are queued, and
+    their tasks created as slots free up. The HTTP connections to a host are capped at 'max_host_connections' (0 for
+    no cap). aiohttp only speaks HTTP/1.1, so 'http2' is ignored, and it doesn't time the phases of the requests, so
+    'telemetry_fields' are ignored too. Websocket requests are made over one persistent connection per URL, with the
+    same id matching and reconnection backoff as WsConnectionPool.
+
+    The loop only runs while the engine is polled.
+    """
+
+    def __init__(
+        self, num_connections: int = 4, max_host_connections: int = 0, http2: bool = False, telemetry_fields: list = ()
+    ):
+        super().__init__()
+        self.num_connections = num_connections
+        self.max_host_connections = max_host_connections
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.ws_session = None
+        self.queue = deque()
+        self.tasks = set()
+        self.ws_connections = {}
+        self.ws_backoffs = {}
+        self.request_ids = itertools.count(1)
+
+    async def open_session(self) -> None:
+        """Create the HTTP and websocket sessions on the engine's loop."""
+        # Concurrency is limited by the task queue, and the persistent websockets have a session of their own so
+        # that they don't take the connection slots of the hosts
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.max_host_connections, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT / 1000.0)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.ws_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), timeout=timeout)
+
+    def update_endpoints(self, added: list, removed: list) -> None:
+        """Drop the queued requests and close the websockets of the removed endpoints.
+
+        The HTTP connections are pooled by the session.
+        """
+        if self.queue:
+            removed_endpoints = set(removed)
+            self.queue = deque(endpoint for endpoint in self.queue if tuple(endpoint) not in removed_endpoints)
+        for _, url, _, request_url in removed:
+            if is_ws_url(url):
+                self.ws_backoffs.pop(request_url, None)
+                if request_url in self.ws_connections:
+                    self.loop.run_until_complete(self.ws_connections.pop(request_url).close())
+
+    def set_resolves(self, resolves: dict) -> None:
+        """Ignored, the connector resolves the hosts and caches their addresses itself."""
+
+    def set_concurrency(self, num_connections: int) -> None:
+        """Set the number of request tasks run at a time, starting queued requests if slots were added."""
+        self.num_connections = num_connections
+        self.start_queued()
+
+    def submit(self, endpoint: tuple) -> None:
+        """Queue the request to an endpoint, its task is run when the engine is polled."""
+        if self.session is None:
+            self.loop.run_until_complete(self.open_session())
+        self.queue.append(endpoint)
+        self.start_queued()
+
+    def start_queued(self) -> None:
+        """Create the tasks of queued requests while there are free slots."""
+        while self.queue and len(self.tasks) < self.num_connections:
+            self.tasks.add(self.loop.create_task(self.probe(*self.queue.popleft())))
+
+    def poll(self, timeout: float) -> list:
+        """Run the loop for up to 'timeout' seconds, returns a list of the results of the requests that completed."""
+        if not self.tasks:
+            time.sleep(max(timeout, 0))
+            return []
+        done, self.tasks = self.loop.run_until_complete(
+            asyncio.wait(self.tasks, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+        )
+        self.start_queued()
+        return [task.result() for task in done]
+
+    async def probe(self, chain: str, url: str, api_class: str, request_url: str) -> dict:
+        """Make a block height request to a single endpoint and return the result dict."""
+        time_start = time.perf_counter()
+        try:
+            if is_ws_url(url):
+                http_code, body = await self.ws_request(request_url, api_class)
+                retry_after = None
+            else:
+                http_code, body, retry_after = await self.http_request(request_url, api_class)
+        except asyncio.TimeoutError:
+            logger.debug("Connection timed out for URL: [%s]", url)
+            return {
+                "chain": chain,
+                "url": url,
+                "http_code": 408,
+                "time_total": None,
+                "latest_block_height": None,
+                "unreachable": True,
+            }
+        except aiohttp.ClientConnectorError as e:
+            logger.debug("Could not connect to URL: [%s], error: [%s]", url, e)
+            return {
+                "chain": chain,
+                "url": url,
+                "http_code": 404,
+                "time_total": None,
+                "latest_block_height": None,
+                "unreachable": True,
+            }
+        except aiohttp.WSServerHandshakeError as e:
+            logger.error("WSServerHandshakeError for URL [%s], error: [%s]", url, e)
+            return {"chain": chain, "url": url, "http_code": 400, "time_total": None, "latest_block_height": None}
+        except Exception as e:
+            # Including websocket connections closed by the server, and frames that aren't JSON
+            logger.error("%s for URL [%s], error: [%s]", e.__class__.__name__, url, e)
+            return {"chain": chain, "url": url, "http_code": 500, "time_total": None, "latest_block_height": None}
+        time_total = time.perf_counter() - time_start
+        try:
+            # Websocket responses were already parsed to match them to their request
+            response = body if isinstance(body, dict) else loads_json(body)
+            block_height = get_highest_block(api_class, response) if validate_response(api_class, response) else None
+            if block_height is None and is_quota_error(response):
+                http_code = 429
+        except Exception as e:
+            pruned_response = prune_response(body)
+            logger.warning(
+                "%s for request to [%s] with response: [%s], http_code: [%s], error: [%s]",
+                e.__class__.__name__,
+                url,
+                pruned_response,
+                http_code,
+                e,
+            )
+            return {
+                "chain": chain,
+                "url": url,
+                "http_code": http_code,
+                "time_total": None,
+                "latest_block_height": None,
+                "retry_after": retry_after,
+            }
+        return {
+            "chain": chain,
+            "url": url,
+            "http_code": http_code,
+            "time_total": time_total,
+            "latest_block_height": block_height,
+            "retry_after": retry_after,
+        }
+
+    async def http_request(self, request_url: str, api_class: str) -> tuple[int, bytes, float]:
+        """Make an HTTP request to the URL and return the HTTP code, the response body and any Retry-After."""
+        api = get_api_class(api_class)
+        request = self.session.request(api.method, request_url, data=api.body, headers=api.header_dict)
+        async with request as response:
+            retry_after = None
+            if response.status in [429, 503]:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            return response.status, await response.read(), retry_after
+
+    async def ws_request(self, request_url: str, api_class: str) -> tuple[int, dict]:
+        """Make a websocket request over the persistent connection to the URL, return the HTTP code and response.
+
+        As with WsConnection, a request that fails on a reused connection, other than by timing out, is sent once
+        more over a new connection before the failure counts.
+        """
+        backoff = self.ws_backoffs.setdefault(request_url, ReconnectBackoff())
+        request_id = next(self.request_ids)
+        api = get_api_class(api_class)
+        try:
+            ws = self.ws_connections.get(request_url)
+            reused = ws is not None and not ws.closed
+            try:
+                response = await self.ws_exchange(request_url, request_id, api, backoff)
+            except Exception as e:
+                if not reused or isinstance(e, asyncio.TimeoutError):
+                    raise
+                logger.debug("Websocket for URL [%s] failed, reconnecting, error: [%s]", request_url, e)
+                await ws.close()
+                self.ws_connections.pop(request_url, None)
+                response = await self.ws_exchange(request_url, request_id, api, backoff)
+        except Exception as e:
+            if e is not backoff.last_error:
+                if request_url in self.ws_connections:
+                    await self.ws_connections.pop(request_url).close()
+                backoff.failed(e)
+            raise
+        backoff.succeeded()
+        return 200, response
+
+    async def ws_exchange(self, request_url: str, request_id: int, api: ApiClass, backoff: ReconnectBackoff) -> dict:
+        """Send the request, connecting first if there is no open connection, and receive its response."""
+        ws = self.ws_connections.get(request_url)
+        if ws is None or ws.closed:
+            backoff.check()
+            ws = await self.ws_session.ws_connect(request_url)
+            self.ws_connections[request_url] = ws
+        await ws.send_str(api.get_request(request_id))
+        return await asyncio.wait_for(self.ws_receive(ws, request_id), timeout=WS_TIMEOUT)
+
+    async def ws_receive(self, ws: aiohttp.ClientWebSocketResponse, request_id: int) -> dict:
+        """Receive messages until the response to the request arrives, dropping replies to earlier requests.
+
+        Raises a ConnectionError if the connection is closed, fails or gets a frame that isn't text.
+        """
+        while True:
+            message = await ws.receive()
+            if message.type != aiohttp.WSMsgType.TEXT:
+                raise ConnectionError("Websocket received a %s frame: %s" % (message.type.name, message.data))
+            response = loads_json(message.data)
+            if isinstance(response, dict) and response.get("id") == request_id:
+                return response
+
+    def close(self) -> None:
+        """Cancel the pending requests and close the websocket connections, the HTTP session and the event loop."""
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            self.loop.run_until_complete(asyncio.wait(self.tasks))
+        self.tasks = set()
+        self.queue = deque()
+        for ws in self.ws_connections.values():
+            self.loop.run_until_complete(ws.close())
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+            self.loop.run_until_complete(self.ws_session.close())
+        self.loop.close()
+
+
+PROBE_ENGINES = {
+    "pycurl": CurlProbeEngine,
+    "asyncio": AsyncioProbeEngine,
+}
+
+
+def get_probe_engine(backend: str, num_connections: int, **options) -> ProbeEngine:
+    """Create the probe engine for the configured backend, passing it the engine options."""
+    if backend not in PROBE_ENGINES:
+        raise ValueError("Invalid probe backend:", backend)
+    return PROBE_ENGINES[backend](num_connections=num_connections, **options)
+
+
+class ProbeScheduler:
+    """Keep a fixed-rate request deadline per endpoint on the monotonic clock and hand out the endpoints when due.
+
+    The endpoints of a chain share their deadlines, so that the block heights compared within a chain are requested
+    at the same time. The chains are spread over the interval by a hash of their name, so that the requests go out at
+    a smoother pace than in one burst. The spread leaves time at the end of the interval for the requests to complete
+    and be reported before the next multiple of the interval, where the monitor's write windows end, see
+    get_window_end(). As the monotonic clock is system-wide, a chain gets the same deadlines in every shard. An
+    optional global cap limits the number of requests dispatched per second, postponing the due endpoints until there
+    is room.
+    """
+
+    def __init__(self, interval: float, max_rate: float = 0):
+        self.interval = interval
+        self.max_rate = max_rate
+        self.deadlines = []
+        self.endpoints = {}
+        self.bucket = TokenBucket(max_rate, max(max_rate, 1.0)) if max_rate else None
+
+    def update_endpoints(self, added: list, removed: list) -> None:
+        """Schedule the added endpoints at their chain's next deadline, and unschedule the removed ones.
+
+        The deadlines of the other endpoints are kept.
+        """
+        for endpoint in removed:
+            self.endpoints.pop(endpoint, None)
+        new_endpoints = [endpoint for endpoint in added if endpoint not in self.endpoints]
+        if len(self.deadlines) > 2 * len(self.endpoints) + len(new_endpoints):
+            # Drop the heap entries of removed endpoints
+            self.deadlines = [(d, e) for d, e in self.deadlines if self.endpoints.get(e) == d]
+            heapq.heapify(self.deadlines)
+        now = time.monotonic()
+        for endpoint in new_endpoints:
+            self.schedule(endpoint, self.next_chain_deadline(endpoint[0], now))
+
+    def next_chain_deadline(self, chain: str, now: float) -> float:
+        """Return the first deadline of a chain after the monotonic time 'now'."""
+        # The longest a request can take to reach the coordinating process
+        request_time = REQUEST_TIMEOUT / 1000.0 + SHARD_REPORT_INTERVAL
+        spread = self.interval - request_time if self.interval > 2 * request_time else self.interval
+        offset = spread * zlib.crc32(chain.encode()) / 2**32
+        deadline = offset + (math.floor((now - offset) / self.interval) + 1) * self.interval
+        # Rounding may land on 'now' itself
+        return deadline if deadline > now else deadline + self.interval
+
+    def schedule(self, endpoint: tuple, deadline: float) -> None:
+        """Set the next deadline of an endpoint."""
+        self.endpoints[endpoint] = deadline
+        heapq.heappush(self.deadlines, (deadline, endpoint))
+
+    def pop_due(self, now: float) -> list:
+        """Return the endpoints that are due, as far as the rate cap allows, and schedule their next deadlines."""
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, endpoint = self.deadlines[0]
+            if self.endpoints.get(endpoint) != deadline:
+                heapq.heappop(self.deadlines)  # Removed or rescheduled endpoint
+                continue
+            if self.bucket and not self.bucket.take(now):
+                break
+            heapq.heappop(self.deadlines)
+            # Keep the chain's fixed rate, skipping the deadlines that have already been missed, and bringing
+            # postponed endpoints back in line with their chain
+            self.schedule(endpoint, self.next_chain_deadline(endpoint[0], now))
+            due.append(endpoint)
+        return due
+
+    def next_deadline(self) -> float:
+        """Return the monotonic time when the next endpoint can be dispatched."""
+        while self.deadlines and self.endpoints.get(self.deadlines[0][1]) != self.deadlines[0][0]:
+            heapq.heappop(self.deadlines)
+        if not self.deadlines:
+            return float("inf")
+        if self.bucket:
+            return max(self.deadlines[0][0], self.bucket.next_token())
+        return self.deadlines[0][0]
+
+
+def get_window_end(now: float, interval: float) -> float:
+    """Return the end of the write window the monotonic time 'now' is in, the next multiple of the interval."""
+    return (math.floor(now / interval) + 1) * interval
+
+
+class TokenBucket:
+    """A token bucket refilled at 'rate' tokens per second, holding up to 'burst' tokens, on the monotonic clock."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        """Add the tokens refilled since the last refill."""
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        """Take a token, returns False if there was none to take."""
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens = self.tokens - 1
+        return True
+
+    def next_token(self) -> float:
+        """Return the monotonic time when there is a token to take."""
+        return self.updated + max(1 - self.tokens, 0) / self.rate
+
+    def drain(self, now: float) -> None:
+        """Empty the bucket."""
+        self.refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RequestThrottle:
+    """Hold back the requests to rate limited endpoints, and pace the requests to each host with a token bucket.
+
+    An endpoint that answers with HTTP 429, a JSON-RPC quota error or a Retry-After is held until the Retry-After
+    has passed. Without a Retry-After, it's held for a backoff that doubles from the request interval with every
+    throttled response in a row, up to THROTTLE_MAX_BACKOFF seconds. With a 'host_rate', the requests to each host are
+    paced by the host's token bucket, which is emptied when one of its endpoints is throttled.
+    """
+
+    def __init__(self, interval: float, host_rate: float = 0):
+        self.interval = interval
+        self.host_rate = host_rate
+        self.holds = {}
+        self.backoffs = {}
+        self.buckets = {}
+
+    def observe(self, key: tuple, host: str, result: dict, now: float) -> bool:
+        """Take in the result of a request to an endpoint, returns whether it was throttled."""
+        retry_after = result.get("retry_after")
+        if result["http_code"] != 429 and not retry_after:
+            if self.holds.pop(key, None):
+                self.backoffs.pop(key, None)
+                logger.info("Endpoint [%s] is no longer throttled", key[1])
+            return False
+        if retry_after:
+            hold = min(retry_after, THROTTLE_MAX_BACKOFF)
+        else:
+            self.backoffs[key] = self.backoffs.get(key, 0) + 1
+            hold = min(self.interval * 2 ** (self.backoffs[key] - 1), THROTTLE_MAX_BACKOFF)
+        self.holds[key] = (now + hold, result["http_code"])
+        if host in self.buckets:
+            self.buckets[host].drain(now)
+        logger.warning(
+            "Endpoint [%s] throttled with HTTP code [%s], holding it for %.0fs", key[1], result["http_code"], hold
+        )
+        return True
+
+    def held(self, key: tuple, now: float) -> int:
+        """Return the HTTP code an endpoint was throttled with, if it's held back, otherwise None."""
+        hold = self.holds.get(key)
+        if hold is None or hold[0] <= now:
+            return None
+        return hold[1]
+
+    def wait_for_host(self, host: str, now: float) -> float:
+        """Take a token of the host's bucket, returns the seconds to wait for one if there is none."""
+        if not self.host_rate or not host:
+            return 0.0
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = TokenBucket(self.host_rate, max(self.host_rate, 1.0))
+        if bucket.take(now):
+            return 0.0
+        return bucket.next_token() - now
+
+    def forget(self, key: tuple) -> None:
+        """Drop the state of a removed endpoint."""
+        self.holds.pop(key, None)
+        self.backoffs.pop(key, None)
+
+
+class ConcurrencyController:
+    """Adapt the number of requests in flight by additive increase and multiplicative decrease.
+
+    The results are observed as they arrive, and the limit is adjusted once per interval, between a floor and a
+    ceiling. The limit is cut when the interval shows signs of contention: the median request time rising well above
+    its baseline, or the share of failed requests rising above its baseline. Otherwise, if the limit held requests
+    back, i.e. requests waited for a free slot for more than CONCURRENCY_MAX_QUEUE_WAIT of the interval or endpoints
+    were due again before their previous request completed, it's raised by one. The baselines follow the healthy
+    intervals, falling at once and rising slowly, so that a lasting change of the network is taken as the new normal.
+    """
+
+    def __init__(self, floor: int, ceiling: int, initial: int, interval: float):
+        self.floor = max(floor, 1)
+        self.ceiling = max(ceiling, self.floor)
+        self.limit = min(max(initial, self.floor), self.ceiling)
+        self.interval = interval
+        self.window_end = time.monotonic() + interval
+        self.baseline_latency = None
+        self.baseline_error_rate = None
+        self.reset()
+
+    def reset(self) -> None:
+        """Clear the observations of the interval."""
+        self.request_times = []
+        self.results = 0
+        self.errors = 0
+        self.held_back = False
+
+    def observe(self, result: dict, queue_wait: float = 0.0) -> None:
+        """Take in a request's result, and the seconds it waited for a free slot."""
+        self.results = self.results + 1
+        if queue_wait > self.interval * CONCURRENCY_MAX_QUEUE_WAIT:
+            self.held_back = True
+        if result["http_code"] != 200:
+            self.errors = self.errors + 1
+        elif result["time_total"]:
+            self.request_times.append(result["time_total"])
+
+    def update(self, now: float) -> bool:
+        """Adjust the limit once the interval has passed, returns whether it changed."""
+        if now < self.window_end:
+            return False
+        self.window_end = now + self.interval
+        if not self.results:
+            self.reset()
+            return False
+        latency = float(np.median(self.request_times)) if self.request_times else None
+        error_rate = self.errors / self.results
+        congested = False
+        if latency is not None and self.baseline_latency is not None:
+            congested = latency > self.baseline_latency * CONCURRENCY_LATENCY_TOLERANCE
+        if self.baseline_error_rate is not None:
+            congested = congested or error_rate > self.baseline_error_rate + CONCURRENCY_ERROR_TOLERANCE
+        limit = self.limit
+        if congested:
+            self.limit = max(self.floor, int(self.limit * CONCURRENCY_DECREASE_FACTOR))
+        else:
+            if latency is not None:
+                self.baseline_latency = follow_baseline(self.baseline_latency, latency)
+            self.baseline_error_rate = follow_baseline(self.baseline_error_rate, error_rate)
+            if self.held_back:
+                self.limit = min(self.ceiling, self.limit + 1)
+        self.reset()
+        if self.limit != limit:
+            logger.info("Request concurrency %s -> %s", limit, self.limit)
+        return self.limit != limit
+
+
+def follow_baseline(baseline: float, value: float) -> float:
+    """Move a baseline towards a value, at once if the value is lower, and slowly if it's higher."""
+    if baseline is None or value < baseline:
+        return value
+    return baseline + CONCURRENCY_BASELINE_WEIGHT * (value - baseline)
+
+
+def get_concurrency_controller(
+    num_connections: int, floor: int, ceiling: int, interval: float
+) -> ConcurrencyController:
+    """Create the concurrency controller if a ceiling is set, returns None for a fixed concurrency."""
+    if not ceiling:
+        return None
+    return ConcurrencyController(floor, ceiling, num_connections, interval)
+
+
+class CircuitBreaker:
+    """Stop requesting endpoints that can't be reached, probing them with exponential backoff instead.
+
+    After 'threshold' requests in a row that failed to resolve, connect or complete, an endpoint's circuit opens: its
+    requests are held back until a probe is due, after twice the request interval, doubling with every failed probe
+    up to CIRCUIT_BREAKER_MAX_BACKOFF seconds. A request that reaches the endpoint, whatever its HTTP code, closes the
+    circuit again. A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, interval: float, threshold: int = 0):
+        self.interval = interval
+        self.threshold = threshold
+        self.failures = {}
+        self.circuits = {}
+
+    def observe(self, key: tuple, result: dict, now: float) -> None:
+        """Take in the result of a request to an endpoint, opening or closing its circuit."""
+        if not self.threshold:
+            return
+        if not result.get("unreachable"):
+            self.failures.pop(key, None)
+            if self.circuits.pop(key, None):
+                logger.info("Endpoint [%s] is reachable again, circuit closed", key[1])
+            return
+        failures = self.failures[key] = self.failures.get(key, 0) + 1
+        if failures < self.threshold:
+            return
+        backoff = min(self.interval * 2 ** (failures - self.threshold + 1), CIRCUIT_BREAKER_MAX_BACKOFF)
+        self.circuits[key] = (now + backoff, result["http_code"])
+        logger.warning(
+            "Endpoint [%s] unreachable for %s requests in a row, probing it again in %.0fs", key[1], failures, backoff
+        )
+
+    def held(self, key: tuple, now: float) -> int:
+        """Return the HTTP code of an endpoint's last failure if its circuit is open, otherwise None."""
+        circuit = self.circuits.get(key)
+        if circuit is None or circuit[0] <= now:
+            return None
+        return circuit[1]
+
+    def forget(self, key: tuple) -> None:
+        """Drop the state of a removed endpoint."""
+        self.failures.pop(key, None)
+        self.circuits.pop(key, None)
+
+
+class ProbeRunner:
+    """Dispatch the block height requests to a probe engine as the scheduler says they're due, collecting the results.
+
+    An endpoint whose previous request hasn't completed when it's due again is skipped for that round. With a
+    concurrency controller, the engine's concurrency is adapted to the results.
+
+    Rate limited endpoints are held back by a RequestThrottle. Instead of the requests of a held endpoint, a result
+    marked 'throttled' is passed on, with the HTTP code it was throttled with. Requests to a host that is out of
+    tokens are postponed until it has one. Likewise, unreachable endpoints are held back by a CircuitBreaker, with
+    results marked 'circuit_open' in place of their requests.
+    """
+
+    def __init__(
+        self,
+        engine: ProbeEngine,
+        interval: float,
+        max_rate: float = 0,
+        controller: ConcurrencyController = None,
+        host_rate: float = 0,
+        breaker_threshold: int = 0,
+    ):
+        self.engine = engine
+        self.scheduler = ProbeScheduler(interval, max_rate)
+        self.controller = controller
+        self.throttle = RequestThrottle(interval, host_rate)
+        self.breaker = CircuitBreaker(interval, breaker_threshold)
+        self.hosts = {}
+        # The dispatch times of the requests in flight
+        self.in_flight = {}
+        if controller:
+            engine.set_concurrency(controller.limit)
+
+    @property
+    def concurrency(self) -> int:
+        """The number of requests the engine keeps in flight."""
+        return self.engine.num_connections
+
+    def update_endpoints(self, http_endpoints: list, ws_endpoints: list, resolves: dict = None) -> None:
+        """Set the endpoints to request, applying only the changes to the engine and the scheduler.
+
+        'resolves' - the resolved addresses of the hosts, if any
+        """
+        if resolves is not None:
+            self.engine.set_resolves(resolves)
+        added, removed = self.engine.sync(http_endpoints, ws_endpoints)
+        self.scheduler.update_endpoints(added, removed)
+        for chain, url, *_ in removed:
+            self.in_flight.pop((chain, url), None)
+            self.hosts.pop((chain, url), None)
+            self.throttle.forget((chain, url))
+            self.breaker.forget((chain, url))
+        for chain, url, _, request_url in added:
+            self.hosts[(chain, url)] = urlparse(request_url).hostname
+
+    def collect(self, until: float, add_result: callable) -> None:
+        """Dispatch due requests and pass the results to 'add_result' until the monotonic time 'until'."""
+        while True:
+            now = time.monotonic()
+            for endpoint in self.scheduler.pop_due(now):
+                chain, url, *_ = endpoint
+                if self.hold(chain, url, now, add_result):
+                    continue
+                host_wait = self.throttle.wait_for_host(self.hosts.get((chain, url)), now)
+                if host_wait:
+                    self.scheduler.schedule(endpoint, now + host_wait)
+                    continue
+                self.in_flight[(chain, url)] = now
+                self.engine.submit(endpoint)
+            if self.controller and self.controller.update(now):
+                self.engine.set_concurrency(self.controller.limit)
+            if now >= until:
+                break
+            timeout = min(until, self.scheduler.next_deadline()) - now
+            for result in self.engine.poll(min(timeout, 1.0)):
+                key = (result["chain"], result["url"])
+                now = time.monotonic()
+                dispatched = self.in_flight.pop(key, now)
+                # The time from the dispatch to the start of the request, known for the timed requests
+                queue_wait = now - dispatched - result["time_total"] if result["time_total"] else 0.0
+                result["throttled"] = self.throttle.observe(key, self.hosts.get(key), result, now)
+                self.breaker.observe(key, result, now)
+                # Being rate limited says nothing about contention
+                if self.controller and not result["throttled"]:
+                    self.controller.observe(result, queue_wait)
+                add_result(result)
+
+    def hold(self, chain: str, url: str, now: float, add_result: callable) -> bool:
+        """Return whether a due request is held back, passing the result reported in its place to 'add_result'.
+
+        A request is held back while the previous request to the endpoint is in flight, which reports nothing, and
+        while the endpoint is throttled or its circuit is open.
+        """
+        if (chain, url) in self.in_flight:
+            logger.debug("Previous request to URL [%s] not completed, skipping", url)
+            if self.controller:
+                self.controller.held_back = True
+            return True
+        throttled_code = self.throttle.held((chain, url), now)
+        if throttled_code:
+            add_result(get_held_result(chain, url, throttled_code, "throttled"))
+            return True
+        failed_code = self.breaker.held((chain, url), now)
+        if failed_code:
+            add_result(get_held_result(chain, url, failed_code, "circuit_open"))
+            return True
+        return False
+
+    def close(self) -> None:
+        """Close the probe engine."""
+        self.engine.close()
+
+
+def get_held_result(chain: str, url: str, http_code: int, reason: str) -> dict:
+    """Get the result reported for a request that was held back, marked with the 'reason' it was held back for."""
+    return {
+        "chain": chain,
+        "url": url,
+        "http_code": http_code,
+        "time_total": None,
+        "latest_block_height": None,
+        reason: True,
+    }
+
+
+class ShardedProbeRunner:
+    """Spread the endpoints over a number of worker processes, each running its own ProbeRunner and probe engine.
+
+    The endpoints are assigned to shards by a hash of their URL, and the workers, spawned as fresh interpreters,
+    stream their results back. Each shard gets an even share of the request and host rate limits.
+    """
+
+    def __init__(
+        self,
+        shard_count: int,
+        backend: str,
+        num_connections: int,
+        interval: float,
+        max_rate: float = 0,
+        concurrency_floor: int = 0,
+        concurrency_ceiling: int = 0,
+        engine_options: dict = None,
+        host_rate: float = 0,
+        breaker_threshold: int = 0,
+    ):
+        self.shard_count = shard_count
+        self.worker_args = (
+            backend,
+            num_connections,
+            interval,
+            max_rate / shard_count,
+            concurrency_floor,
+            concurrency_ceiling,
+            engine_options or {},
+            host_rate / shard_count,
+            breaker_threshold,
+            logger.getEffectiveLevel(),
+        )
+        self.context = multiprocessing.get_context("spawn")
+        self.result_queue = self.context.Queue()
+        self.shard_endpoints = [([], [], {}) for _ in range(shard_count)]
+        self.shard_concurrency = [num_connections] * shard_count
+        self.workers = [self.start_worker(shard) for shard in range(shard_count)]
+
+    def start_worker(self, shard: int) -> tuple:
+        """Start the worker process of a shard, returns the process and its endpoint queue."""
+        endpoint_queue = self.context.Queue()
+        endpoint_queue.put(self.shard_endpoints[shard])
+        process = self.context.Process(
+            target=run_probe_shard,
+            args=(endpoint_queue, self.result_queue, shard, *self.worker_args),
+            name=f"probe-shard-{shard}",
+            daemon=True,
+        )
+        process.start()
+        return process, endpoint_queue
+
+    @property
+    def concurrency(self) -> int:
+        """The number of requests the workers keep in flight, as last reported."""
+        return sum(self.shard_concurrency)
+
+    def update_endpoints(self, http_endpoints: list, ws_endpoints: list, resolves: dict = None) -> None:
+        """Partition the endpoints over the shards and send each worker its endpoints, if they changed.
+
+        The resolved addresses of the hosts are sent along to every worker.
+        """
+        shard_endpoints = [([], [], resolves or {}) for _ in range(self.shard_count)]
+        for i, endpoints in enumerate((http_endpoints, ws_endpoints)):
+            for endpoint in endpoints:
+                shard_endpoints[zlib.crc32(endpoint[1].encode()) % self.shard_count][i].append(endpoint)
+        for shard, endpoints in enumerate(shard_endpoints):
+            if endpoints != self.shard_endpoints[shard]:
+                self.shard_endpoints[shard] = endpoints
+                self.workers[shard][1].put(endpoints)
+
+    def collect(self, until: float, add_result: callable) -> None:
+        """Pass the results streamed by the workers to 'add_result' until the monotonic time 'until'."""
+        self.restart_dead_workers()
+        while True:
+            timeout = until - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                shard, concurrency, shard_results = self.result_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            self.shard_concurrency[shard] = concurrency
+            for result in shard_results:
+                add_result(result)
+
+    def restart_dead_workers(self) -> None:
+        """Restart the worker processes that have died."""
+        for shard, (process, _) in enumerate(self.workers):
+            if not process.is_alive():
+                logger.error("Probe shard %s died with exit code %s, restarting it", shard, process.exitcode)
+                self.workers[shard] = self.start_worker(shard)
+
+    def close(self) -> None:
+        """Stop the worker processes."""
+        for process, endpoint_queue in self.workers:
+            endpoint_queue.put(None)
+        for process, _ in self.workers:
+            process.join(timeout=REQUEST_TIMEOUT / 1000.0)
+            if process.is_alive():
+                process.terminate()
+
+
+def run_probe_shard(
+    endpoint_queue: multiprocessing.Queue,
+    result_queue: multiprocessing.Queue,
+    shard: int,
+    backend: str,
+    num_connections: int,
+    interval: float,
+    max_rate: float,
+    concurrency_floor: int,
+    concurrency_ceiling: int,
+    engine_options: dict,
+    host_rate: float,
+    breaker_threshold: int,
+    log_level: int,
+) -> None:
+    """Run the requests of a shard's endpoints in a worker process, streaming the results to the result queue.
+
+    The latest endpoint lists are read from the endpoint queue, and None on it stops the worker. The results are sent
+    along with the shard and the worker's current concurrency.
+    """
+    parent_pid = os.getppid()
+    logger.setLevel(log_level)
+    API_CLASSES.update(load_api_classes(Path.cwd() / API_CLASSES_FILE))
+    controller = get_concurrency_controller(num_connections, concurrency_floor, concurrency_ceiling, interval)
+    engine = get_probe_engine(backend, num_connections=num_connections, **engine_options)
+    runner = ProbeRunner(engine, interval, max_rate, controller, host_rate, breaker_threshold)
+    try:
+        # Exit if the coordinating process is gone
+        while os.getppid() == parent_pid:
+            endpoints = ()
+            try:
+                while True:
+                    endpoints = endpoint_queue.get_nowait()
+                    if endpoints is None:
+                        return
+            except queue.Empty:
+                pass
+            if endpoints:
+                runner.update_endpoints(*endpoints)
+            results = []
+            runner.collect(until=time.monotonic() + SHARD_REPORT_INTERVAL, add_result=results.append)
+            if results:
+                result_queue.put((shard, runner.concurrency, results))
+    finally:
+        runner.close()
+
+
+def split_headers(headers: list) -> dict:
+    """Convert a list of 'Name: value' header lines into a header dict."""
+    return dict(header.split(": ", 1) for header in headers)
 
 
 if __name__ == "__main__":
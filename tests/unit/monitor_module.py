@@ -0,0 +1,35 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+"""The monitor script, loaded as a module for its unit tests.
+
+The script can't be imported by its file name.
+"""
+
+import importlib.util
+from pathlib import Path
+
+TEMPLATES_DIR = Path(__file__).parents[2] / "templates"
+
+_spec = importlib.util.spec_from_file_location(
+    "monitor_blockchains", TEMPLATES_DIR / "monitor-blockchains.py"
+)
+monitor = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(monitor)
+monitor.API_CLASSES.update(monitor.load_api_classes(TEMPLATES_DIR / monitor.API_CLASSES_FILE))
+
+
+def endpoint(chain, name, api_class="ethereum"):
+    """Make an endpoint tuple, requested at its own URL."""
+    url = f"https://{name}.example.com"
+    return (chain, url, api_class, url)
+
+
+class FakeClock:
+    """A monotonic clock that only moves when it's told to."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
@@ -0,0 +1,87 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import unittest
+
+from monitor_module import endpoint, monitor
+
+
+class TestAggregateBlockHeights(unittest.TestCase):
+    def setUp(self):
+        # Chains interleaved, so that the rows have to be sorted by chain
+        self.endpoints = [
+            endpoint("eth", "eth-0"),
+            endpoint("dot", "dot-0"),
+            endpoint("eth", "eth-1"),
+            endpoint("dot", "dot-1"),
+            endpoint("eth", "eth-2"),
+            endpoint("eth", "eth-3"),
+            endpoint("sol", "sol-0"),
+        ]
+        self.table = monitor.ResultTable()
+        self.table.set_endpoints(self.endpoints)
+
+    def set(self, index, http_code, block_height):
+        chain, url, *_ = self.endpoints[index]
+        self.table.set(chain, url, http_code, block_height, 0.1)
+
+    def test_max_heights_and_lags(self):
+        for index, height in enumerate([100, 50, 98, 47, 100, 90]):
+            self.set(index, 200, height)
+        aggregation = monitor.aggregate_block_heights(self.table, 5)
+        chains = [self.table.chains[chain_id] for chain_id in aggregation["chain_ids"]]
+        self.assertEqual(dict(zip(chains, aggregation["max_heights"])), {"eth": 100, "dot": 50})
+        self.assertEqual(aggregation["lags"], [0, 0, 2, 3, 0, 10, -1])
+        self.assertEqual(aggregation["rows"], [0, 1, 2, 3, 4, 5])
+
+    def test_counts_medians_and_within_threshold(self):
+        for index, height in enumerate([100, 50, 98, 47, 100, 90]):
+            self.set(index, 200, height)
+        aggregation = monitor.aggregate_block_heights(self.table, 2)
+        chains = [self.table.chains[chain_id] for chain_id in aggregation["chain_ids"]]
+        summary = dict(
+            zip(
+                chains,
+                zip(
+                    aggregation["counts"],
+                    aggregation["median_lags"],
+                    aggregation["within_threshold"],
+                ),
+            )
+        )
+        # eth lags 0, 2, 0, 10: the median of an even count is the mean of the middle two
+        self.assertEqual(summary["eth"], (4, 1.0, 0.75))
+        # dot lags 0, 3
+        self.assertEqual(summary["dot"], (2, 1.5, 0.5))
+
+    def test_median_of_an_odd_count(self):
+        for index, height in [(0, 100), (2, 97), (4, 90)]:
+            self.set(index, 200, height)
+        aggregation = monitor.aggregate_block_heights(self.table, 5)
+        self.assertEqual(aggregation["median_lags"], [3.0])
+        self.assertEqual(aggregation["within_threshold"], [2 / 3])
+
+    def test_results_without_block_height_count_as_rows_only(self):
+        self.set(0, 200, 100)
+        self.set(2, 500, None)
+        self.set(6, 408, None)
+        aggregation = monitor.aggregate_block_heights(self.table, 5)
+        self.assertEqual(aggregation["rows"], [0, 2, 6])
+        self.assertEqual(aggregation["lags"], [0, -1, -1, -1, -1, -1, -1])
+        self.assertEqual(aggregation["counts"], [1])
+
+    def test_rows_without_result(self):
+        aggregation = monitor.aggregate_block_heights(self.table, 5)
+        self.assertEqual(aggregation["rows"], [])
+        self.assertEqual(aggregation["chain_ids"], [])
+        self.assertEqual(aggregation["lags"], [-1] * len(self.endpoints))
+
+    def test_empty_table(self):
+        aggregation = monitor.aggregate_block_heights(monitor.ResultTable(), 5)
+        self.assertEqual(aggregation["rows"], [])
+        self.assertEqual(aggregation["lags"], [])
+
+    def test_clear_drops_the_previous_results(self):
+        self.set(0, 200, 100)
+        self.table.clear()
+        self.assertEqual(monitor.aggregate_block_heights(self.table, 5)["rows"], [])
@@ -0,0 +1,87 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+
+from monitor_module import monitor
+
+# A sample block height response of every registered API class, with its block height
+SAMPLES = {
+    "substrate": ({"jsonrpc": "2.0", "result": {"number": "0x1234"}, "id": 1}, 0x1234),
+    "ethereum": ({"jsonrpc": "2.0", "result": "0x12a05f2", "id": 1}, 0x12A05F2),
+    "starknet": ({"jsonrpc": "2.0", "result": 654321, "id": 1}, 654321),
+    "filecoin": ({"jsonrpc": "2.0", "result": {"Height": 3500000}, "id": 1}, 3500000),
+    "sui": ({"jsonrpc": "2.0", "result": "27000123", "id": 1}, 27000123),
+    "ton": ({"ok": True, "result": {"last": {"seqno": 38000000}}}, 38000000),
+    "waves": ({"height": 4200000}, 4200000),
+    "tonv3": ({"last": {"seqno": 38000001}}, 38000001),
+    "sidecar": ({"number": "20000000", "hash": "0xabc"}, 20000000),
+    "cosmos-tendermint": ({"block": {"header": {"height": "17000000"}}}, 17000000),
+    "eos": ({"head_block_num": 350000000}, 350000000),
+    "eth-v1-beacon": ({"data": [{"header": {"message": {"slot": "8000000"}}}]}, 8000000),
+    "tron": ({"block_header": {"raw_data": {"number": 60000000}}}, 60000000),
+    "movement": ({"block_height": "5000000"}, 5000000),
+}
+
+
+class TestApiClasses(unittest.TestCase):
+    def test_every_registered_class_has_a_sample(self):
+        self.assertEqual(set(monitor.API_CLASSES), set(SAMPLES))
+
+    def test_block_height_of_the_samples(self):
+        for api_class, (response, block_height) in SAMPLES.items():
+            with self.subTest(api_class=api_class):
+                self.assertTrue(monitor.validate_response(api_class, response))
+                self.assertEqual(monitor.get_highest_block(api_class, response), block_height)
+
+    def test_cosmos_status_response_falls_back_to_the_sync_info(self):
+        response = {"result": {"sync_info": {"latest_block_height": "17000001"}}}
+        self.assertTrue(monitor.validate_response("cosmos-tendermint", response))
+        self.assertEqual(monitor.get_highest_block("cosmos-tendermint", response), 17000001)
+
+    def test_cosmos_block_response_is_tried_first(self):
+        response = {
+            "block": {"header": {"height": "17000002"}},
+            "result": {"sync_info": {"latest_block_height": "1"}},
+        }
+        self.assertEqual(monitor.get_highest_block("cosmos-tendermint", response), 17000002)
+
+    def test_hex_and_decimal_bases(self):
+        hex_class = monitor.ApiClass(
+            "hex", json_rpc_method="m", height_paths=[["result"]], height_base=16
+        )
+        decimal_class = monitor.ApiClass("decimal", json_rpc_method="m", height_paths=[["result"]])
+        self.assertEqual(hex_class.get_block_height({"result": "0xff"}), 255)
+        self.assertEqual(hex_class.get_block_height({"result": "ff"}), 255)
+        self.assertEqual(decimal_class.get_block_height({"result": "255"}), 255)
+        # Numbers aren't parsed with the base
+        self.assertEqual(hex_class.get_block_height({"result": 255}), 255)
+
+    def test_missing_height_raises_the_last_paths_error(self):
+        with self.assertRaises(KeyError):
+            monitor.get_highest_block("cosmos-tendermint", {"result": {}})
+        with self.assertRaises(IndexError):
+            monitor.get_highest_block("eth-v1-beacon", {"data": []})
+
+    def test_error_response_is_not_valid(self):
+        response = {"jsonrpc": "2.0", "error": {"code": -32000, "message": "error"}, "id": 1}
+        self.assertFalse(monitor.validate_response("ethereum", response))
+
+    def test_json_rpc_request(self):
+        request = json.loads(monitor.get_api_class("ethereum").get_request(7))
+        self.assertEqual(
+            request, {"method": "eth_blockNumber", "params": [], "id": 7, "jsonrpc": "2.0"}
+        )
+        self.assertEqual(json.loads(monitor.get_api_class("ethereum").body)["id"], 1)
+        self.assertIsNone(monitor.get_api_class("waves").body)
+
+    def test_invalid_entries(self):
+        with self.assertRaises(ValueError):
+            monitor.ApiClass("put", method="PUT", height_paths=[["height"]])
+        with self.assertRaises(ValueError):
+            monitor.ApiClass("post", height_paths=[["result"]])
+        with self.assertRaises(ValueError):
+            monitor.ApiClass("get", method="GET")
+        with self.assertRaises(ValueError):
+            monitor.get_api_class("unknown")
@@ -0,0 +1,69 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import unittest
+
+from monitor_module import monitor
+
+INTERVAL = 10.0
+KEY = ("eth", "https://rpc.example.com")
+
+
+def result(http_code, unreachable):
+    return {"http_code": http_code, "unreachable": unreachable}
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = monitor.CircuitBreaker(INTERVAL, threshold=3)
+
+    def fail(self, now, times=1):
+        for _ in range(times):
+            self.breaker.observe(KEY, result(-2, True), now)
+
+    def test_circuit_stays_closed_below_the_threshold(self):
+        self.fail(0.0, times=2)
+        self.assertIsNone(self.breaker.held(KEY, 0.0))
+
+    def test_circuit_opens_at_the_threshold(self):
+        self.fail(0.0, times=3)
+        self.assertEqual(self.breaker.held(KEY, 2 * INTERVAL - 1), -2)
+        self.assertIsNone(self.breaker.held(KEY, 2 * INTERVAL))
+
+    def test_backoff_doubles_with_every_failed_probe(self):
+        self.fail(0.0, times=3)
+        for now, backoff in [(20.0, 4 * INTERVAL), (60.0, 8 * INTERVAL)]:
+            self.fail(now)
+            self.assertEqual(self.breaker.circuits[KEY][0], now + backoff)
+
+    def test_backoff_is_capped(self):
+        self.fail(0.0, times=20)
+        self.assertEqual(self.breaker.circuits[KEY][0], monitor.CIRCUIT_BREAKER_MAX_BACKOFF)
+
+    def test_reachable_endpoint_closes_the_circuit(self):
+        self.fail(0.0, times=3)
+        # Any HTTP code closes it, as long as the endpoint was reached
+        self.breaker.observe(KEY, result(500, False), 20.0)
+        self.assertIsNone(self.breaker.held(KEY, 20.0))
+        self.fail(20.0, times=2)
+        self.assertIsNone(self.breaker.held(KEY, 20.0))
+
+    def test_zero_threshold_disables_the_breaker(self):
+        breaker = monitor.CircuitBreaker(INTERVAL)
+        for _ in range(10):
+            breaker.observe(KEY, result(-2, True), 0.0)
+        self.assertIsNone(breaker.held(KEY, 0.0))
+        self.assertEqual(breaker.failures, {})
+
+    def test_forget_drops_the_endpoint(self):
+        self.fail(0.0, times=3)
+        self.breaker.forget(KEY)
+        self.assertIsNone(self.breaker.held(KEY, 0.0))
+        self.assertNotIn(KEY, self.breaker.failures)
+
+    def test_held_result_of_an_open_circuit(self):
+        held = monitor.get_held_result("eth", KEY[1], -2, "circuit_open")
+        self.assertEqual(held["chain"], "eth")
+        self.assertEqual(held["url"], KEY[1])
+        self.assertEqual(held["http_code"], -2)
+        self.assertTrue(held["circuit_open"])
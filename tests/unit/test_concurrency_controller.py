@@ -0,0 +1,150 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest import mock
+
+from monitor_module import FakeClock, endpoint, monitor
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def setUp(self):
+        self.controller = monitor.ConcurrencyController(2, 10, 8, 1.0)
+
+    def run_interval(self, latency, errors=0, results=20, held_back=True):
+        """Observe an interval of results, then update the limit at its end."""
+        for i in range(results):
+            http_code = 500 if i < errors else 200
+            self.controller.observe({"http_code": http_code, "time_total": latency})
+        self.controller.held_back = held_back
+        return self.controller.update(self.controller.window_end)
+
+    def test_limit_is_kept_between_floor_and_ceiling(self):
+        self.assertEqual(monitor.ConcurrencyController(2, 10, 20, 1.0).limit, 10)
+        self.assertEqual(monitor.ConcurrencyController(2, 10, 0, 1.0).limit, 2)
+        self.assertEqual(monitor.ConcurrencyController(0, 0, 0, 1.0).limit, 1)
+
+    def test_limit_is_not_updated_before_the_interval_has_passed(self):
+        self.controller.observe({"http_code": 200, "time_total": 0.1})
+        self.controller.held_back = True
+        self.assertFalse(self.controller.update(self.controller.window_end - 0.5))
+        self.assertEqual(self.controller.limit, 8)
+
+    def test_limit_is_raised_by_one_when_requests_are_held_back(self):
+        self.assertTrue(self.run_interval(0.1))
+        self.assertEqual(self.controller.limit, 9)
+        self.assertTrue(self.run_interval(0.1))
+        self.assertEqual(self.controller.limit, 10)
+        self.assertFalse(self.run_interval(0.1))
+        self.assertEqual(self.controller.limit, 10)
+
+    def test_limit_is_kept_when_nothing_is_held_back(self):
+        self.assertFalse(self.run_interval(0.1, held_back=False))
+        self.assertEqual(self.controller.limit, 8)
+
+    def test_limit_is_kept_without_results(self):
+        self.controller.held_back = True
+        self.assertFalse(self.controller.update(self.controller.window_end))
+        self.assertEqual(self.controller.limit, 8)
+
+    def test_long_queue_wait_holds_requests_back(self):
+        self.controller.observe({"http_code": 200, "time_total": 0.1}, queue_wait=0.5)
+        self.assertTrue(self.controller.update(self.controller.window_end))
+        self.assertEqual(self.controller.limit, 9)
+
+    def test_short_queue_wait_doesnt_hold_requests_back(self):
+        self.controller.observe({"http_code": 200, "time_total": 0.1}, queue_wait=0.05)
+        self.assertFalse(self.controller.update(self.controller.window_end))
+        self.assertEqual(self.controller.limit, 8)
+
+    def test_limit_is_cut_when_the_latency_rises_above_its_baseline(self):
+        self.run_interval(0.1, held_back=False)
+        self.assertTrue(self.run_interval(0.1 * monitor.CONCURRENCY_LATENCY_TOLERANCE * 1.1))
+        self.assertEqual(self.controller.limit, int(8 * monitor.CONCURRENCY_DECREASE_FACTOR))
+
+    def test_limit_is_cut_when_the_error_rate_rises_above_its_baseline(self):
+        self.run_interval(0.1, held_back=False)
+        self.assertTrue(self.run_interval(0.1, errors=10))
+        self.assertEqual(self.controller.limit, int(8 * monitor.CONCURRENCY_DECREASE_FACTOR))
+
+    def test_limit_is_not_cut_below_the_floor(self):
+        self.run_interval(0.1, held_back=False)
+        for _ in range(10):
+            self.run_interval(0.1, errors=20)
+        self.assertEqual(self.controller.limit, 2)
+
+    def test_congested_interval_leaves_the_baselines(self):
+        self.run_interval(0.1, held_back=False)
+        self.run_interval(1.0)
+        self.assertEqual(self.controller.baseline_latency, 0.1)
+
+    def test_baseline_falls_at_once_and_rises_slowly(self):
+        self.assertEqual(monitor.follow_baseline(None, 0.5), 0.5)
+        self.assertEqual(monitor.follow_baseline(0.5, 0.2), 0.2)
+        self.assertAlmostEqual(
+            monitor.follow_baseline(0.2, 0.3), 0.2 + monitor.CONCURRENCY_BASELINE_WEIGHT * 0.1
+        )
+
+    def test_no_controller_without_a_ceiling(self):
+        self.assertIsNone(monitor.get_concurrency_controller(8, 2, 0, 1.0))
+        self.assertEqual(monitor.get_concurrency_controller(8, 2, 16, 1.0).limit, 8)
+
+
+class SlottedProbeEngine(monitor.ProbeEngine):
+    """A probe engine on a fake clock, making 'num_connections' requests of 'request_time' at a time."""
+
+    def __init__(self, clock, num_connections, request_time):
+        super().__init__()
+        self.clock = clock
+        self.num_connections = num_connections
+        self.request_time = request_time
+        self.queue = []
+        self.running = []
+
+    def update_endpoints(self, added, removed):
+        pass
+
+    def set_concurrency(self, num_connections):
+        self.num_connections = num_connections
+
+    def submit(self, endpoint):
+        self.queue.append(endpoint)
+        self.start_queued()
+
+    def start_queued(self):
+        while self.queue and len(self.running) < self.num_connections:
+            self.running.append((self.clock.now + self.request_time, self.queue.pop(0)))
+
+    def poll(self, timeout):
+        until = min([self.clock.now + timeout] + [done for done, _ in self.running])
+        self.clock.now = max(self.clock.now, until)
+        completed = [endpoint for done, endpoint in self.running if done <= self.clock.now]
+        self.running = [r for r in self.running if r[0] > self.clock.now]
+        self.start_queued()
+        return [
+            {"chain": chain, "url": url, "http_code": 200, "time_total": self.request_time}
+            for chain, url, *_ in completed
+        ]
+
+
+class TestProbeRunnerConcurrency(unittest.TestCase):
+    INTERVAL = 10.0
+
+    def run_intervals(self, request_time, num_intervals=5):
+        """Request a chain with more endpoints than the limit, returns the limit after the intervals."""
+        clock = FakeClock(1000.0)
+        engine = SlottedProbeEngine(clock, 2, request_time)
+        endpoints = [endpoint("eth", f"eth-{i}") for i in range(8)]
+        with mock.patch.object(monitor.time, "monotonic", clock.monotonic):
+            controller = monitor.ConcurrencyController(2, 8, 2, self.INTERVAL)
+            runner = monitor.ProbeRunner(engine, self.INTERVAL, controller=controller)
+            runner.update_endpoints(endpoints, [])
+            for _ in range(num_intervals):
+                runner.collect(until=clock.now + self.INTERVAL, add_result=lambda result: None)
+        return controller.limit
+
+    def test_limit_is_kept_when_the_queued_requests_complete_in_time(self):
+        self.assertEqual(self.run_intervals(0.1), 2)
+
+    def test_limit_is_raised_when_the_queued_requests_wait_too_long(self):
+        self.assertGreater(self.run_intervals(1.0), 2)
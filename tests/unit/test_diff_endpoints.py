@@ -0,0 +1,43 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import unittest
+
+from monitor_module import endpoint, monitor
+
+
+class TestDiffEndpoints(unittest.TestCase):
+    def diff(self, previous, current):
+        return monitor.diff_endpoints(
+            monitor.index_endpoints(previous), monitor.index_endpoints(current)
+        )
+
+    def test_endpoints_are_keyed_by_chain_and_url(self):
+        eth = endpoint("eth", "eth-0")
+        self.assertEqual(monitor.index_endpoints([list(eth)]), {eth[:2]: eth})
+
+    def test_unchanged_endpoints_are_neither_added_nor_removed(self):
+        endpoints = [endpoint("eth", "eth-0"), endpoint("dot", "dot-0")]
+        self.assertEqual(self.diff(endpoints, list(reversed(endpoints))), ([], []))
+
+    def test_added_and_removed_endpoints(self):
+        eth, dot, sol = (
+            endpoint("eth", "eth-0"),
+            endpoint("dot", "dot-0"),
+            endpoint("sol", "sol-0"),
+        )
+        self.assertEqual(self.diff([eth, dot], [eth, sol]), ([sol], [dot]))
+
+    def test_same_url_on_another_chain_is_another_endpoint(self):
+        eth = endpoint("eth", "rpc")
+        goerli = endpoint("goerli", "rpc")
+        self.assertEqual(self.diff([eth], [eth, goerli]), ([goerli], []))
+
+    def test_changed_endpoint_is_removed_and_added(self):
+        before = endpoint("eth", "eth-0")
+        after = endpoint("eth", "eth-0", api_class="ethereum-beacon")
+        self.assertEqual(self.diff([before], [after]), ([after], [before]))
+
+    def test_all_endpoints_are_added_at_first(self):
+        endpoints = [endpoint("eth", "eth-0"), endpoint("dot", "dot-0")]
+        self.assertEqual(self.diff([], endpoints), (endpoints, []))
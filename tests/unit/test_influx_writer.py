@@ -0,0 +1,84 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from influxdb_client.rest import ApiException
+from monitor_module import monitor
+
+GOOD = b"block_height_request,chain=eth,url=u http_code=200i 1\n"
+BAD = b"block_height_request,chain=eth,url=u http_code=200 1\n"
+
+
+class FakeWriteApi:
+    """Fail the writes of bad records with 'status', and the first write with 'first_status'."""
+
+    def __init__(self, status=400, first_status=None):
+        self.status = status
+        self.first_status = first_status
+        self.written = []
+
+    def write(self, bucket, record, write_precision):
+        if self.first_status:
+            status, self.first_status = self.first_status, None
+            raise ApiException(status=status)
+        if BAD in record:
+            raise ApiException(status=self.status)
+        self.written.append(record)
+
+
+class TestInfluxWriter(unittest.TestCase):
+    def writer(self, write_api, spool=None):
+        writer = monitor.InfluxWriter(
+            "http://localhost:8086", "token", "org", "bucket", batch_size=1, spool=spool
+        )
+        writer.write_api = write_api
+        return writer
+
+    def test_rejected_writes(self):
+        for status, rejected in [
+            (400, True),
+            (422, True),
+            (408, False),
+            (429, False),
+            (503, False),
+        ]:
+            with self.subTest(status=status):
+                self.assertEqual(monitor.is_rejected_write(ApiException(status=status)), rejected)
+        self.assertFalse(monitor.is_rejected_write(ConnectionError()))
+
+    def test_rejected_batch_is_dropped(self):
+        write_api = FakeWriteApi()
+        writer = self.writer(write_api)
+        writer.write(BAD, 1)
+        writer.write(GOOD, 1)
+        writer.close()
+        self.assertEqual(write_api.written, [GOOD])
+        self.assertEqual(writer.dropped, 1)
+
+    def test_failed_batch_is_retried(self):
+        write_api = FakeWriteApi(first_status=503)
+        writer = self.writer(write_api)
+        writer.write(GOOD, 1)
+        # A failed write isn't retried once the writer is closed
+        deadline = time.monotonic() + 5.0
+        while not write_api.written and time.monotonic() < deadline:
+            time.sleep(0.05)
+        writer.close()
+        self.assertEqual(write_api.written, [GOOD])
+        self.assertEqual(writer.dropped, 0)
+
+    def test_rejected_spool_segment_is_committed(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        spool = monitor.ResultSpool(Path(directory.name), 1_000_000, len(BAD))
+        write_api = FakeWriteApi(status=422)
+        writer = self.writer(write_api, spool)
+        writer.write(BAD, 1)
+        writer.write(GOOD, 1)
+        writer.close()
+        self.assertEqual(write_api.written, [GOOD])
+        self.assertEqual(list(Path(directory.name).glob("*.lp")), [])
@@ -0,0 +1,100 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import unittest
+
+from monitor_module import monitor
+
+
+class TestEscapeTag(unittest.TestCase):
+    def test_escapes_the_line_protocol_special_characters(self):
+        self.assertEqual(monitor.escape_tag("a b,c=d"), b"a\\ b\\,c\\=d")
+        self.assertEqual(monitor.escape_tag("back\\slash"), b"back\\\\slash")
+        self.assertEqual(monitor.escape_tag("new\nline\ttab\r"), b"new\\nline\\ttab\\r")
+
+    def test_plain_values_are_unchanged(self):
+        self.assertEqual(
+            monitor.escape_tag("https://api-eth.example.com/rpc"),
+            b"https://api-eth.example.com/rpc",
+        )
+
+    def test_encodes_utf8(self):
+        self.assertEqual(monitor.escape_tag("kédé"), "kédé".encode("utf-8"))
+
+
+class TestLineProtocolSerializer(unittest.TestCase):
+    def setUp(self):
+        self.serializer = monitor.LineProtocolSerializer("s")
+        self.serializer.start(1700000000.7)
+
+    def test_request_line(self):
+        self.serializer.add_request("eth", "https://a b", 200, 1000, 2, 0.25, False)
+        self.assertEqual(
+            self.serializer.getvalue(),
+            b"block_height_request,chain=eth,url=https://a\\ b "
+            b"http_code=200i,block_height_diff=2i,block_height=1000i,request_time_total=0.25"
+            b" 1700000000\n",
+        )
+        self.assertEqual(self.serializer.count, 1)
+
+    def test_failed_request_gets_the_timeout_as_request_time(self):
+        self.serializer.add_request("eth", "u", 408, 0, None, None, False)
+        self.assertEqual(
+            self.serializer.getvalue(),
+            b"block_height_request,chain=eth,url=u "
+            b"http_code=408i,request_time_total=%r 1700000000\n"
+            % (monitor.REQUEST_TIMEOUT / 1000.0),
+        )
+
+    def test_subscription_has_no_request_time(self):
+        self.serializer.add_request("eth", "u", 200, 1000, 0, None, True)
+        self.assertNotIn(b"request_time_total", self.serializer.getvalue())
+
+    def test_held_back_requests_have_no_request_time(self):
+        self.serializer.add_request("eth", "u", 429, 0, None, None, False, throttled=True)
+        self.serializer.add_request("eth", "u", 404, 0, None, None, False, circuit_open=True)
+        self.assertEqual(
+            self.serializer.getvalue(),
+            b"block_height_request,chain=eth,url=u http_code=429i,throttled=true 1700000000\n"
+            b"block_height_request,chain=eth,url=u "
+            b"http_code=404i,circuit_open=true 1700000000\n",
+        )
+
+    def test_telemetry_fields(self):
+        serializer = monitor.LineProtocolSerializer(
+            "s", ["request_time_connect", "request_size_download"]
+        )
+        serializer.start(1)
+        serializer.add_request("eth", "u", 200, 5, 0, 0.5, False, [0.125, 42])
+        self.assertEqual(
+            serializer.getvalue(),
+            b"block_height_request,chain=eth,url=u "
+            b"http_code=200i,block_height_diff=0i,block_height=5i,request_time_total=0.5,"
+            b"request_time_connect=0.125,request_size_download=42i 1\n",
+        )
+
+    def test_max_and_summary_lines(self):
+        self.serializer.add_max("eth", 1000)
+        self.serializer.add_chain_summary("eth", 3, 0.5, 1.0)
+        self.assertEqual(
+            self.serializer.getvalue(),
+            b"block_height_request,chain=eth,url=zzz\\ -\\ Max\\ over\\ time "
+            b"block_height=1000i 1700000000\n"
+            b"chain_block_height_summary,chain=eth "
+            b"endpoints=3i,median_block_height_diff=0.5,within_lag_threshold=1.0 1700000000\n",
+        )
+
+    def test_millisecond_precision(self):
+        serializer = monitor.LineProtocolSerializer("ms")
+        serializer.start(1700000000.7)
+        serializer.add_max("eth", 1)
+        self.assertTrue(serializer.getvalue().endswith(b" 1700000000700\n"))
+
+    def test_start_clears_the_buffer(self):
+        self.serializer.add_max("eth", 1)
+        self.serializer.start(1)
+        self.assertEqual((self.serializer.getvalue(), self.serializer.count), (b"", 0))
+
+    def test_invalid_precision(self):
+        with self.assertRaises(ValueError):
+            monitor.LineProtocolSerializer("ns")
@@ -0,0 +1,137 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import random
+import unittest
+from unittest import mock
+
+from monitor_module import FakeClock, endpoint, monitor
+
+INTERVAL = 10.0
+
+
+class TestProbeScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = monitor.ProbeScheduler(INTERVAL)
+        self.eth = [endpoint("eth", f"eth-{i}") for i in range(3)]
+        self.dot = [endpoint("dot", f"dot-{i}") for i in range(3)]
+        self.scheduler.update_endpoints(self.eth + self.dot, [])
+
+    def test_endpoints_of_a_chain_share_their_deadline(self):
+        eth_deadlines = {self.scheduler.endpoints[e] for e in self.eth}
+        dot_deadlines = {self.scheduler.endpoints[e] for e in self.dot}
+        self.assertEqual(len(eth_deadlines), 1)
+        self.assertEqual(len(dot_deadlines), 1)
+
+    def test_chain_offsets_leave_time_for_the_requests(self):
+        spread = INTERVAL - monitor.REQUEST_TIMEOUT / 1000.0 - monitor.SHARD_REPORT_INTERVAL
+        for chain in ["eth", "dot", "sol", "ton"]:
+            deadline = self.scheduler.next_chain_deadline(chain, 0.0)
+            self.assertGreater(deadline, 0.0)
+            self.assertLess(deadline % INTERVAL, spread)
+
+    def test_chain_deadlines_are_the_same_for_every_scheduler(self):
+        other = monitor.ProbeScheduler(INTERVAL)
+        self.assertEqual(
+            other.next_chain_deadline("eth", 123.4),
+            self.scheduler.next_chain_deadline("eth", 123.4),
+        )
+
+    def test_pop_due_schedules_the_next_deadline_one_interval_later(self):
+        deadline = self.scheduler.endpoints[self.eth[0]]
+        due = self.scheduler.pop_due(deadline)
+        self.assertTrue(set(self.eth) <= set(due))
+        for e in self.eth:
+            self.assertAlmostEqual(self.scheduler.endpoints[e], deadline + INTERVAL)
+
+    def test_pop_due_skips_missed_deadlines(self):
+        deadline = self.scheduler.endpoints[self.eth[0]]
+        # Dispatched two and a half intervals late
+        due = self.scheduler.pop_due(deadline + 2.5 * INTERVAL)
+        self.assertTrue(set(self.eth) <= set(due))
+        for e in self.eth:
+            self.assertAlmostEqual(self.scheduler.endpoints[e], deadline + 3 * INTERVAL)
+
+    def test_postponed_endpoint_rejoins_its_chain(self):
+        deadline = self.scheduler.endpoints[self.eth[0]]
+        self.scheduler.pop_due(deadline)
+        self.scheduler.schedule(self.eth[0], deadline + INTERVAL + 1.5)
+        self.scheduler.pop_due(deadline + INTERVAL)
+        self.assertEqual(self.scheduler.pop_due(deadline + INTERVAL + 1.5), [self.eth[0]])
+        self.assertAlmostEqual(self.scheduler.endpoints[self.eth[0]], deadline + 2 * INTERVAL)
+        self.assertAlmostEqual(self.scheduler.endpoints[self.eth[1]], deadline + 2 * INTERVAL)
+
+    def test_endpoint_is_not_due_again_at_its_dispatch_time(self):
+        deadline = self.scheduler.endpoints[self.eth[0]]
+        self.scheduler.pop_due(deadline)
+        self.assertNotIn(self.eth[0], self.scheduler.pop_due(deadline))
+
+    def test_removed_endpoints_are_not_due(self):
+        self.scheduler.update_endpoints([], [self.eth[0]])
+        due = self.scheduler.pop_due(self.scheduler.endpoints[self.eth[1]])
+        self.assertNotIn(self.eth[0], due)
+        self.assertIn(self.eth[1], due)
+
+    def test_rate_cap_postpones_due_endpoints(self):
+        scheduler = monitor.ProbeScheduler(INTERVAL, max_rate=2)
+        scheduler.update_endpoints(self.eth, [])
+        deadline = scheduler.endpoints[self.eth[0]]
+        self.assertEqual(len(scheduler.pop_due(deadline)), 2)
+        self.assertGreater(scheduler.next_deadline(), deadline)
+        self.assertEqual(len(scheduler.pop_due(deadline + 0.5)), 1)
+
+    def test_next_deadline_without_endpoints(self):
+        self.assertEqual(monitor.ProbeScheduler(INTERVAL).next_deadline(), float("inf"))
+
+
+class JitteryProbeEngine(monitor.ProbeEngine):
+    """A probe engine on a fake clock, whose requests take a random time up to the request timeout."""
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+        self.random = random.Random(0)
+        self.completions = []
+
+    def update_endpoints(self, added, removed):
+        pass
+
+    def submit(self, endpoint):
+        request_time = self.random.uniform(0.0, monitor.REQUEST_TIMEOUT / 1000.0)
+        self.completions.append((self.clock.now + request_time, endpoint))
+
+    def poll(self, timeout):
+        until = min([self.clock.now + timeout] + [done for done, _ in self.completions])
+        self.clock.now = max(self.clock.now, until)
+        completed = [endpoint for done, endpoint in self.completions if done <= self.clock.now]
+        self.completions = [c for c in self.completions if c[0] > self.clock.now]
+        return [
+            {"chain": chain, "url": url, "http_code": 200, "time_total": 0.1}
+            for chain, url, *_ in completed
+        ]
+
+
+class TestWriteWindows(unittest.TestCase):
+    def test_window_ends_on_the_next_multiple_of_the_interval(self):
+        self.assertEqual(monitor.get_window_end(123.4, INTERVAL), 130.0)
+        self.assertEqual(monitor.get_window_end(130.0, INTERVAL), 140.0)
+
+    def test_one_result_per_endpoint_per_window(self):
+        clock = FakeClock(1002.37)
+        engine = JitteryProbeEngine(clock)
+        endpoints = [endpoint(f"chain-{c}", f"rpc-{c}-{i}") for c in range(20) for i in range(3)]
+        with mock.patch.object(monitor.time, "monotonic", clock.monotonic):
+            runner = monitor.ProbeRunner(engine, INTERVAL)
+            runner.update_endpoints(endpoints, [])
+            window_end = monitor.get_window_end(clock.now, INTERVAL)
+            windows = []
+            for _ in range(6):
+                results = []
+                runner.collect(until=window_end, add_result=results.append)
+                windows.append(sorted((r["chain"], r["url"]) for r in results))
+                # The loop's processing between two windows
+                clock.now = clock.now + engine.random.uniform(0.0, 0.5)
+                window_end = window_end + INTERVAL
+        # The first window is cut short, and holds the requests of only some of the chains
+        for results in windows[1:]:
+            self.assertEqual(results, sorted((chain, url) for chain, url, *_ in endpoints))
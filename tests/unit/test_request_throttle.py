@@ -0,0 +1,105 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import time
+import unittest
+
+from monitor_module import monitor
+
+INTERVAL = 10.0
+KEY = ("eth", "https://rpc.example.com")
+HOST = "rpc.example.com"
+
+
+def result(http_code, retry_after=None):
+    return {"http_code": http_code, "retry_after": retry_after}
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.bucket = monitor.TokenBucket(2.0, 2.0)
+        self.bucket.updated = 0.0
+
+    def test_burst_is_taken_at_once(self):
+        self.assertTrue(self.bucket.take(0.0))
+        self.assertTrue(self.bucket.take(0.0))
+        self.assertFalse(self.bucket.take(0.0))
+
+    def test_tokens_are_refilled_at_the_rate(self):
+        self.bucket.take(0.0)
+        self.bucket.take(0.0)
+        self.assertEqual(self.bucket.next_token(), 0.5)
+        self.assertFalse(self.bucket.take(0.25))
+        self.assertTrue(self.bucket.take(0.5))
+
+    def test_refill_is_capped_at_the_burst(self):
+        self.bucket.refill(100.0)
+        self.assertEqual(self.bucket.tokens, 2.0)
+
+    def test_drained_bucket_waits_for_a_token(self):
+        self.bucket.drain(0.0)
+        self.assertFalse(self.bucket.take(0.0))
+        self.assertEqual(self.bucket.next_token(), 0.5)
+
+
+class TestRequestThrottle(unittest.TestCase):
+    def setUp(self):
+        self.throttle = monitor.RequestThrottle(INTERVAL)
+
+    def test_successful_request_is_not_throttled(self):
+        self.assertFalse(self.throttle.observe(KEY, HOST, result(200), 0.0))
+        self.assertIsNone(self.throttle.held(KEY, 0.0))
+
+    def test_throttled_endpoint_is_held_for_the_request_interval(self):
+        self.assertTrue(self.throttle.observe(KEY, HOST, result(429), 0.0))
+        self.assertEqual(self.throttle.held(KEY, INTERVAL - 1), 429)
+        self.assertIsNone(self.throttle.held(KEY, INTERVAL))
+
+    def test_backoff_doubles_while_throttled(self):
+        for now, hold in [(0.0, INTERVAL), (10.0, 2 * INTERVAL), (30.0, 4 * INTERVAL)]:
+            self.throttle.observe(KEY, HOST, result(429), now)
+            self.assertEqual(self.throttle.holds[KEY][0], now + hold)
+
+    def test_backoff_is_capped(self):
+        self.throttle.backoffs[KEY] = 20
+        self.throttle.observe(KEY, HOST, result(429), 0.0)
+        self.assertEqual(self.throttle.holds[KEY][0], monitor.THROTTLE_MAX_BACKOFF)
+
+    def test_retry_after_sets_the_hold(self):
+        self.assertTrue(self.throttle.observe(KEY, HOST, result(503, retry_after=42.0), 0.0))
+        self.assertEqual(self.throttle.held(KEY, 41.0), 503)
+        self.assertIsNone(self.throttle.held(KEY, 42.0))
+        self.assertNotIn(KEY, self.throttle.backoffs)
+
+    def test_successful_request_releases_the_endpoint(self):
+        self.throttle.observe(KEY, HOST, result(429), 0.0)
+        self.throttle.observe(KEY, HOST, result(429), 10.0)
+        self.assertFalse(self.throttle.observe(KEY, HOST, result(200), 30.0))
+        self.throttle.observe(KEY, HOST, result(429), 40.0)
+        self.assertEqual(self.throttle.holds[KEY][0], 40.0 + INTERVAL)
+
+    def test_forget_drops_the_endpoint(self):
+        self.throttle.observe(KEY, HOST, result(429), 0.0)
+        self.throttle.forget(KEY)
+        self.assertIsNone(self.throttle.held(KEY, 0.0))
+        self.assertNotIn(KEY, self.throttle.backoffs)
+
+    def test_hosts_are_not_paced_without_a_host_rate(self):
+        for _ in range(10):
+            self.assertEqual(self.throttle.wait_for_host(HOST, 0.0), 0.0)
+
+    def test_host_requests_are_paced_by_the_host_rate(self):
+        throttle = monitor.RequestThrottle(INTERVAL, host_rate=2.0)
+        # The buckets are created full, on the monotonic clock
+        self.assertEqual(throttle.wait_for_host(HOST, time.monotonic()), 0.0)
+        now = time.monotonic()
+        self.assertEqual(throttle.wait_for_host(HOST, now), 0.0)
+        self.assertAlmostEqual(throttle.wait_for_host(HOST, now), 0.5, places=3)
+        self.assertEqual(throttle.wait_for_host("other.example.com", now), 0.0)
+
+    def test_throttled_endpoint_drains_its_host_bucket(self):
+        throttle = monitor.RequestThrottle(INTERVAL, host_rate=2.0)
+        throttle.wait_for_host(HOST, time.monotonic())
+        now = time.monotonic()
+        throttle.observe(KEY, HOST, result(429), now)
+        self.assertAlmostEqual(throttle.wait_for_host(HOST, now), 0.5, places=3)
@@ -0,0 +1,98 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from monitor_module import monitor
+
+RECORD = b"block_height_request,chain=eth,url=u http_code=200i 1\n"
+
+
+class TestResultSpool(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def spool(
+        self, max_size=1_000_000, segment_size=len(RECORD) * 2, precision="s", fsync="segment"
+    ):
+        return monitor.ResultSpool(
+            self.directory, max_size, segment_size, fsync=fsync, precision=precision
+        )
+
+    def test_segment_rotates_at_its_size(self):
+        spool = self.spool()
+        spool.append(RECORD)
+        self.assertEqual(spool.segments, [])
+        spool.append(RECORD)
+        self.assertEqual([path.name for path in spool.segments], ["000000000000.s.lp"])
+
+    def test_read_batch_rotates_the_active_segment_when_nothing_else_is_waiting(self):
+        spool = self.spool()
+        spool.append(RECORD)
+        data, num_lines, precision, segments = spool.read_batch(100)
+        self.assertEqual((data, num_lines, precision), (RECORD, 1, "s"))
+        self.assertEqual(len(segments), 1)
+
+    def test_read_batch_reads_whole_segments_oldest_first(self):
+        spool = self.spool()
+        for i in range(6):
+            spool.append(RECORD.replace(b" 1\n", b" %d\n" % i))
+        data, num_lines, _, segments = spool.read_batch(3)
+        # At least 'max_lines', in whole segments
+        self.assertEqual(num_lines, 4)
+        self.assertEqual(data.splitlines()[0][-1:], b"0")
+        self.assertEqual(
+            [path.name for path in segments], ["000000000000.s.lp", "000000000001.s.lp"]
+        )
+
+    def test_read_batch_stops_at_a_change_of_precision(self):
+        self.spool(precision="s").append(RECORD * 2)
+        spool = self.spool(precision="ms")
+        spool.append(RECORD * 2)
+        _, num_lines, precision, segments = spool.read_batch(100)
+        self.assertEqual((num_lines, precision, len(segments)), (2, "s", 1))
+        spool.commit(segments)
+        _, num_lines, precision, segments = spool.read_batch(100)
+        self.assertEqual((num_lines, precision, len(segments)), (2, "ms", 1))
+
+    def test_commit_deletes_the_segments(self):
+        spool = self.spool()
+        spool.append(RECORD * 2)
+        _, _, _, segments = spool.read_batch(100)
+        spool.commit(segments)
+        self.assertEqual(spool.segments, [])
+        self.assertFalse(any(self.directory.iterdir()))
+
+    def test_evicts_the_oldest_segments_over_max_size(self):
+        spool = self.spool(max_size=len(RECORD) * 5)
+        for i in range(4):
+            spool.append(RECORD * 2)
+        self.assertEqual(
+            [path.name for path in spool.segments], ["000000000002.s.lp", "000000000003.s.lp"]
+        )
+        self.assertEqual(
+            sorted(path.name for path in self.directory.iterdir()),
+            [p.name for p in spool.segments],
+        )
+
+    def test_segments_of_an_earlier_run_are_replayed_first(self):
+        self.spool().append(RECORD * 2)
+        spool = self.spool()
+        spool.append(RECORD * 2)
+        self.assertEqual(
+            [path.name for path in spool.segments], ["000000000000.s.lp", "000000000001.s.lp"]
+        )
+
+    def test_close_makes_the_active_segment_readable(self):
+        spool = self.spool()
+        spool.append(RECORD)
+        spool.close()
+        self.assertEqual(len(self.spool().segments), 1)
+
+    def test_invalid_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            self.spool(fsync="sometimes")
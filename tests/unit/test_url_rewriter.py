@@ -0,0 +1,72 @@
+# Copyright 2023 Jakob Andersson
+# See LICENSE file for licensing details.
+
+import unittest
+
+from monitor_module import monitor
+
+RULES = [
+    {"contains": ["gateway.example.com", "/ws"], "path": "/ws"},
+    {"contains": ["gateway.example.com"], "api_class": "substrate", "path": "/rpc"},
+    {"contains": ["gateway.example.com"]},
+]
+
+
+class TestUrlRewriter(unittest.TestCase):
+    def setUp(self):
+        self.rewriter = monitor.UrlRewriter(RULES, "key")
+
+    def test_key_is_inserted_in_front_of_the_path(self):
+        self.assertEqual(
+            self.rewriter.rewrite("wss://eth.gateway.example.com/ws", "ethereum"),
+            "wss://eth.gateway.example.com/key/ws",
+        )
+
+    def test_key_is_appended_without_a_path(self):
+        self.assertEqual(
+            self.rewriter.rewrite("https://eth.gateway.example.com", "ethereum"),
+            "https://eth.gateway.example.com/key",
+        )
+
+    def test_rule_of_another_api_class_is_skipped(self):
+        self.assertEqual(
+            self.rewriter.rewrite("https://dot.gateway.example.com/rpc", "substrate"),
+            "https://dot.gateway.example.com/key/rpc",
+        )
+        self.assertEqual(
+            self.rewriter.rewrite("https://eth.gateway.example.com/rpc", "ethereum"),
+            "https://eth.gateway.example.com/rpc/key",
+        )
+
+    def test_first_matching_rule_wins(self):
+        self.assertEqual(
+            self.rewriter.rewrite("wss://dot.gateway.example.com/ws", "substrate"),
+            "wss://dot.gateway.example.com/key/ws",
+        )
+
+    def test_unmatched_url_is_unchanged(self):
+        url = "https://rpc.other.org"
+        self.assertEqual(self.rewriter.rewrite(url, "ethereum"), url)
+
+    def test_nothing_is_rewritten_without_an_api_key(self):
+        rewriter = monitor.UrlRewriter(RULES, "")
+        url = "https://eth.gateway.example.com"
+        self.assertEqual(rewriter.rewrite(url, "ethereum"), url)
+
+    def test_request_urls_are_added_to_the_endpoints(self):
+        endpoints = [
+            ("eth", "https://eth.gateway.example.com", "ethereum"),
+            ("eth", "https://rpc.other.org", "ethereum"),
+        ]
+        self.assertEqual(
+            self.rewriter.add_request_urls(endpoints),
+            [
+                (*endpoints[0], "https://eth.gateway.example.com/key"),
+                (*endpoints[1], "https://rpc.other.org"),
+            ],
+        )
+
+    def test_request_urls_of_removed_endpoints_are_dropped(self):
+        self.rewriter.add_request_urls([("eth", "https://eth.gateway.example.com", "ethereum")])
+        self.rewriter.add_request_urls([("eth", "https://rpc.other.org", "ethereum")])
+        self.assertEqual(list(self.rewriter.request_urls), [("https://rpc.other.org", "ethereum")])